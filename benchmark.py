@@ -0,0 +1,149 @@
+#!/bin/python3
+
+from pyhprof.parsers import HProfParser
+from pyhprof.references import ReferenceBuilder
+from pyhprof.secret_scanner import SecretScanner
+from pyhprof.writer import generate_file
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+try:
+	from truffleHogRegexes.regexChecks import regexes
+except ImportError:
+	regexes = {'AWS API Key': 'AKIA[0-9A-Z]{16}'}
+
+# Each phase returns the number of records it handled and the number of bytes it read
+
+def parse_phase(filename, flags):
+	records = 0
+	with open(filename, 'rb') as f:
+		p = HProfParser(f, flags['mmap'])
+		for b in p:
+			records += 1
+			if b.tag_name == 'HEAP_DUMP' or b.tag_name == 'HEAP_DUMP_SEGMENT':
+				for el in b:
+					records += 1
+	return records, os.path.getsize(filename)
+
+def build_phase(filename, flags):
+	with open(filename, 'rb') as f:
+		refs = ReferenceBuilder(f, flags)
+		refs.build()
+		records = len(refs.references) + len(refs.references.root_ids) + len(refs.classes)
+	return records, os.path.getsize(filename)
+
+def scan_phase(filename, flags):
+	with open(filename, 'rb') as f:
+		refs = ReferenceBuilder(f, flags)
+		refs.build()
+		arrays = [(r.id, r.ascii_data()) for r in refs.references.values('PRIMITIVE_ARRAY_DUMP')]
+	scanner = SecretScanner(regexes, workers=flags['workers'])
+	start = time.time()
+	for hit in scanner.scan(arrays):
+		pass
+	# Only the scan itself is timed
+	return len(arrays), sum(len(data) for id, data in arrays), time.time() - start
+
+PHASES = {
+	'parse': parse_phase,
+	'build': build_phase,
+	'scan': scan_phase
+}
+
+def run_phase(name, filename, flags, results):
+	start = time.time()
+	result = PHASES[name](filename, flags)
+	elapsed = time.time() - start
+	if len(result) == 3:
+		records, size, elapsed = result
+	else:
+		records, size = result
+	# ru_maxrss is in kilobytes on Linux
+	results.put((records, size, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+def measure(name, filename, flags, repeat):
+	"""Run a phase `repeat` times, each in a fresh process so its peak RSS is its own,
+	keeping the fastest run
+	"""
+	ctx = multiprocessing.get_context('spawn')
+	best = None
+	for _ in range(repeat):
+		results = ctx.Queue()
+		process = ctx.Process(target=run_phase, args=(name, filename, flags, results))
+		process.start()
+		result = results.get()
+		process.join()
+		if best is None or result[2] < best[2]:
+			best = result
+	records, size, elapsed, rss = best
+	return {
+		'phase': name,
+		'records': records,
+		'bytes': size,
+		'seconds': elapsed,
+		'records_per_second': records / elapsed,
+		'mb_per_second': size / elapsed / 2 ** 20,
+		'peak_rss_mb': rss / 2 ** 20
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark pyhprof on a synthetic or given HPROF file')
+	parser.add_argument('-f', '--filename', dest='filename',
+	                    help='HPROF file to benchmark, instead of generating one')
+	parser.add_argument('-p', '--phases', default='parse,build,scan',
+	                    help='Comma separated phases to run, of parse, build and scan')
+	parser.add_argument('-n', '--repeat', type=int, default=3,
+	                    help='Runs of each phase, the fastest is reported')
+	parser.add_argument('-j', '--json', action='store_true',
+	                    help='Write results as JSON lines')
+	parser.add_argument('-m', '--mmap', action='store_true',
+	                    help='Memory map the HPROF')
+	parser.add_argument('-w', '--workers', type=int, default=1,
+	                    help='Processes for parsing segments and scanning')
+	parser.add_argument('--format', default='1.0.2', choices=['1.0.1', '1.0.2'],
+	                    help='Format of the generated HPROF')
+	parser.add_argument('--id-size', type=int, default=8, choices=[4, 8])
+	parser.add_argument('--segment-size', type=int, default=2 ** 20,
+	                    help='Bytes per heap dump segment, 0 for a single HEAP_DUMP')
+	parser.add_argument('--classes', type=int, default=100)
+	parser.add_argument('--instances', type=int, default=100000)
+	parser.add_argument('--object-arrays', type=int, default=10000)
+	parser.add_argument('--primitive-arrays', type=int, default=50000)
+	parser.add_argument('--strings', type=int, default=1000)
+	parser.add_argument('--variables', type=int, default=1000)
+
+	args = parser.parse_args()
+
+	flags = {'type_one': False, 'type_two': False, 'mmap': args.mmap, 'workers': args.workers}
+
+	filename = args.filename
+	if filename is None:
+		fd, filename = tempfile.mkstemp(suffix='.hprof')
+		os.close(fd)
+		generate_file(filename, id_size=args.id_size, format=b'JAVA PROFILE ' + args.format.encode(),
+		              segment_size=args.segment_size or None, classes=args.classes,
+		              instances=args.instances, object_arrays=args.object_arrays,
+		              primitive_arrays=args.primitive_arrays, strings=args.strings,
+		              variables=args.variables)
+	try:
+		if not args.json:
+			print("%s: %.1f MB" % (filename, os.path.getsize(filename) / 2 ** 20))
+		for name in args.phases.split(','):
+			result = measure(name, filename, flags, args.repeat)
+			if args.json:
+				print(json.dumps(result), flush=True)
+			else:
+				print("%-6s %10d records %8.2fs %12.0f records/s %8.2f MB/s %8.1f MB peak RSS" % (
+					name, result['records'], result['seconds'], result['records_per_second'],
+					result['mb_per_second'], result['peak_rss_mb']), flush=True)
+	finally:
+		if args.filename is None:
+			os.remove(filename)
+
+if __name__ == '__main__':
+	main()
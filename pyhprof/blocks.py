@@ -36,12 +36,17 @@ class StringBlock(BaseBlock):
 
     def read_contents(self):
         with self.parser.goto(self.start):
-            try:
-                s_id = self.parser.read_id()
-                contents = self.parser.f.read(self.length - self.parser.id_size)
-                contents = contents.decode('utf-8')
-            except:
-                contents = str(contents)
+            self.parse_contents()
+
+    def parse_contents(self):
+        """Read the contents with the parser at the start of the record
+        """
+        try:
+            s_id = self.parser.read_id()
+            contents = bytes(self.parser.read(self.length - self.parser.id_size))
+            contents = contents.decode('utf-8')
+        except:
+            contents = str(contents)
         self._id = s_id
         self._contents = contents
 
@@ -66,10 +71,13 @@ class LoadClass(BaseBlock):
 
     def read_contents(self):
         with self.parser.goto(self.start):
-            self._serial_number = self.parser.i4()
-            self._class_id = self.parser.read_id()
-            self._stack_trace = self.parser.i4()
-            self._class_name_id = self.parser.read_id()
+            self.parse_contents()
+
+    def parse_contents(self):
+        self._serial_number = self.parser.i4()
+        self._class_id = self.parser.read_id()
+        self._stack_trace = self.parser.i4()
+        self._class_name_id = self.parser.read_id()
 
     @property
     def class_id(self):
@@ -92,7 +100,7 @@ class HeapDump(BaseBlock):
             yield HeapDumpParser(self.parser.f, self.parser.id_size, self.length)
 
     def __iter__(self):
-        with heap_parser(self) as hp:
+        with self.heap_parser() as hp:
             for b in hp:
                 yield b
 
@@ -100,5 +108,6 @@ class HeapDump(BaseBlock):
 BLOCK_CLASSES_BY_TAG = {
     'STRING': StringBlock,
     'LOAD_CLASS': LoadClass,
-    'HEAP_DUMP': HeapDump
+    'HEAP_DUMP': HeapDump,
+    'HEAP_DUMP_SEGMENT': HeapDump
 }
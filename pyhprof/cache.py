@@ -0,0 +1,220 @@
+"""On-disk cache of the state ReferenceBuilder parses out of a dump, so that later runs
+over the same dump can skip parsing it.
+"""
+
+import hashlib
+import os
+import struct
+from array import array
+
+from .constants import OBJECT_TYPES, OBJECT_TYPE_CODES, TYPE_STRUCT_CODES
+from .index import pack_strings, unpack_strings, read_sections, write_sections
+from .parsers import ID_CODES
+from .store import ObjectStore
+
+CACHE_SUFFIX = '.pyhprof-cache'
+# Changes whenever the layout of the cached sections does
+CACHE_VERSION = b'PYHPROF-CACHE\x01'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pyhprof')
+
+
+def pack_values(structs, values, blob, keys, types):
+    """Append (name or index, type name, value) triples to the `keys` and `types` columns,
+    packing the values into `blob` as in the dump
+    """
+    for key, tp, value in values:
+        keys.append(key)
+        types.append(OBJECT_TYPE_CODES[tp])
+        blob += structs['>' + TYPE_STRUCT_CODES[tp]].pack(value)
+
+
+def unpack_values(structs, keys, types, blob, position):
+    values = []
+    for key, code in zip(keys, types):
+        tp = OBJECT_TYPES[code]
+        s = structs['>' + TYPE_STRUCT_CODES[tp]]
+        values.append([key, tp, s.unpack_from(blob, position)[0]])
+        position += s.size
+    return values, position
+
+
+class HeapCache(object):
+    """Directory of cached parses, one memory mappable file per dump (written with
+    write_sections) named after a hash of the dump's fingerprint, see file_fingerprint.
+
+    An entry holds the string and class tables, the classes, the ObjectStore and the
+    positions of the heap dump records. Loading one touches its modification time, and
+    writing one evicts the least recently used entries until the directory holds at most
+    `max_bytes` of them.
+    """
+
+    def __init__(self, directory=None, max_bytes=8 * 2 ** 30):
+        self.directory = directory or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+
+    def path(self, fingerprint):
+        return os.path.join(self.directory, hashlib.sha1(CACHE_VERSION + fingerprint).hexdigest() + CACHE_SUFFIX)
+
+    def entries(self):
+        """(last use time, size, path) of every entry, least recently used first
+        """
+        try:
+            names = os.listdir(self.directory)
+        except (IOError, OSError):
+            return []
+        entries = []
+        for name in names:
+            if name.endswith(CACHE_SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries, other than the one at `keep`, until the
+        entries fit in `max_bytes`
+        """
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def invalidate(self, fingerprint):
+        """Remove the entry of a dump, if any
+        """
+        try:
+            os.remove(self.path(fingerprint))
+        except OSError:
+            pass
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def save(self, fingerprint, structs, strings, class_name_ids, classes, store, heap_dumps):
+        """Write the entry of a dump, returning False if it could not be written or would not
+        fit in `max_bytes` by itself. `classes` are JavaClass objects and `heap_dumps` the
+        dump's heap dump blocks
+        """
+        id_code = ID_CODES[store.id_size]
+        string_ids, string_offsets, string_blob = pack_strings(strings, id_code)
+        class_ids = array(id_code)
+        super_class_ids = array(id_code)
+        # Instance fields, static fields and constants of every class, in CSR form
+        starts = dict((name, array('Q', [0])) for name in ('if', 'sf', 'cp'))
+        columns = dict((name, (array('Q'), array('B'))) for name in ('if', 'sf', 'cp'))
+        blob = bytearray()
+        for c in classes.values():
+            class_ids.append(c.id)
+            super_class_ids.append(c.parent_class_id)
+            keys, types = columns['if']
+            keys.extend(name_id for name_id, tp in c.instance_fields)
+            types.extend(OBJECT_TYPE_CODES[tp] for name_id, tp in c.instance_fields)
+            pack_values(structs, c.static_fields, blob, *columns['sf'])
+            pack_values(structs, c.constants, blob, *columns['cp'])
+            for name, column in starts.items():
+                column.append(len(columns[name][0]))
+        sections = [
+            ('str_ids', string_ids),
+            ('str_offs', string_offsets),
+            ('str_blob', string_blob),
+            ('cls_ids', array(id_code, class_name_ids.keys())),
+            ('cls_name', array(id_code, class_name_ids.values())),
+            ('jc_ids', class_ids),
+            ('jc_super', super_class_ids),
+            ('jc_blob', array('B', bytes(blob))),
+        ]
+        for name in ('if', 'sf', 'cp'):
+            sections.append((name + '_strt', starts[name]))
+            sections.append((name + '_key', columns[name][0]))
+            sections.append((name + '_tp', columns[name][1]))
+        sections.extend([
+            ('ids', array(id_code, store.ids)),
+            ('kinds', array('B', store.kinds)),
+            ('cls_idx', array('i', store.class_indexes)),
+            ('offsets', array('Q', store.offsets)),
+            ('sizes', array('Q', store.sizes)),
+            ('edge_off', array('Q', store.edge_offsets)),
+            ('edges', array(id_code, store.edges)),
+            ('root_ids', array(id_code, store.root_ids)),
+            ('root_knd', array('B', store.root_kinds)),
+            ('st_cls', array(id_code, store.class_ids)),
+            ('st_asc', array('B', [store.ascending])),
+            ('hd_tags', array('B', (b.tag for b in heap_dumps))),
+            ('hd_times', array('I', (b.record_time for b in heap_dumps))),
+            ('hd_start', array('Q', (b.start for b in heap_dumps))),
+            ('hd_len', array('Q', (b.length for b in heap_dumps))),
+        ])
+        if sum(a.itemsize * len(a) for name, a in sections) > self.max_bytes:
+            return False
+        path = self.path(fingerprint)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            write_sections(path, CACHE_VERSION + fingerprint, sections)
+        except (IOError, OSError):
+            return False
+        self.evict(keep=path)
+        return True
+
+    def load(self, fingerprint, structs, load_reference=None):
+        """Memory map the entry of a dump, returning (strings, class_name_ids, classes,
+        store, heap dumps) or None if there is none. Classes are (id, name, super class id,
+        instance fields, static fields, constants) tuples and heap dumps (tag, record time,
+        start, length) tuples. The store's columns are views of the mapping
+        """
+        path = self.path(fingerprint)
+        s = read_sections(path, CACHE_VERSION + fingerprint)
+        if s is None:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        strings = unpack_strings(s['str_ids'], s['str_offs'], s['str_blob'])
+        class_name_ids = dict(zip(s['cls_ids'], s['cls_name']))
+
+        blob = s['jc_blob']
+        position = 0
+        classes = []
+        for i, id in enumerate(s['jc_ids']):
+            start, end = s['if_strt'][i], s['if_strt'][i + 1]
+            instance_fields = [[name_id, OBJECT_TYPES[code]] for name_id, code in
+                               zip(s['if_key'][start:end], s['if_tp'][start:end])]
+            start, end = s['sf_strt'][i], s['sf_strt'][i + 1]
+            static_fields, position = unpack_values(structs, s['sf_key'][start:end], s['sf_tp'][start:end],
+                                                    blob, position)
+            start, end = s['cp_strt'][i], s['cp_strt'][i + 1]
+            constants, position = unpack_values(structs, s['cp_key'][start:end], s['cp_tp'][start:end],
+                                                blob, position)
+            classes.append((id, strings.get(class_name_ids.get(id)), s['jc_super'][i], instance_fields,
+                            static_fields, constants))
+
+        store = ObjectStore(load_reference, struct.calcsize(s['ids'].format))
+        store.ids = s['ids']
+        store.kinds = s['kinds']
+        store.class_indexes = s['cls_idx']
+        store.offsets = s['offsets']
+        store.sizes = s['sizes']
+        store.edge_offsets = s['edge_off']
+        store.edges = s['edges']
+        store.root_ids = s['root_ids']
+        store.root_kinds = s['root_knd']
+        store.class_ids = list(s['st_cls'])
+        store.class_index_by_id = dict((class_id, i) for i, class_id in enumerate(store.class_ids))
+        store.ascending = bool(s['st_asc'][0])
+        heap_dumps = list(zip(s['hd_tags'], s['hd_times'], s['hd_start'], s['hd_len']))
+        return strings, class_name_ids, classes, store, heap_dumps
@@ -0,0 +1,150 @@
+"""Reading compressed (gzip, or zstd when the zstandard package is installed) hprof files
+without decompressing them to disk first.
+"""
+
+import bisect
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def is_compressed(f):
+    """Whether a file, at its current position, starts with a gzip or zstd frame
+    """
+    position = f.tell()
+    magic = f.read(4)
+    f.seek(position)
+    return magic.startswith(GZIP_MAGIC) or magic == ZSTD_MAGIC
+
+
+class CompressedFile(object):
+    """Read-only file-like view of the decompressed contents of a compressed file.
+
+    Data is decompressed sequentially, `read_size` bytes at a time, and forward seeks
+    decompress and discard. Seeking backwards restarts decompression, from the start of
+    the file or, for gzip files read with a `checkpoint_interval`, from the nearest of the
+    decompressor states saved every `checkpoint_interval` decompressed bytes. Seeks only
+    take effect on the next read, so going somewhere and back costs nothing.
+    """
+
+    # Parsers should avoid going back, see HProfParser.read_next_block_sequential
+    sequential = True
+
+    def __init__(self, f, checkpoint_interval=None, read_size=2 ** 20):
+        self.file = f
+        self.name = getattr(f, 'name', None)
+        self.start = f.tell()
+        self.checkpoint_interval = checkpoint_interval
+        self.read_size = read_size
+        magic = f.read(4)
+        f.seek(self.start)
+        if magic.startswith(GZIP_MAGIC):
+            self.gzip = True
+        elif magic == ZSTD_MAGIC:
+            if zstandard is None:
+                raise ValueError('Reading zstd compressed files requires the zstandard package')
+            self.gzip = False
+        else:
+            raise ValueError('Unknown compression format')
+        # (decompressed offset, compressed offset, decompressor) sorted by offset
+        self.checkpoints = []
+        self.restart()
+
+    def restart(self, checkpoint=None):
+        if checkpoint is None:
+            self.file.seek(self.start)
+            if self.gzip:
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                # Read past the first frame, as pzstd and zstd with several inputs write many
+                self.decompressor = zstandard.ZstdDecompressor().stream_reader(self.file, read_across_frames=True,
+                                                                               closefd=False)
+            self.buffer_start = 0
+        else:
+            self.buffer_start, compressed_offset, decompressor = checkpoint
+            self.file.seek(compressed_offset)
+            self.decompressor = decompressor.copy()
+        self.pending = b''
+        self.buffer = b''
+        self.offset = 0
+        self.seek_to = None
+
+    def fill(self):
+        """Replace the buffer with the next piece of decompressed data, returning False at
+        the end of the file
+        """
+        self.buffer_start += len(self.buffer)
+        self.offset = 0
+        if not self.gzip:
+            self.buffer = self.decompressor.read(self.read_size)
+            return bool(self.buffer)
+        d = self.decompressor
+        while True:
+            if not self.pending:
+                self.pending = self.file.read(self.read_size)
+                if not self.pending:
+                    self.buffer = b''
+                    return False
+            self.buffer = d.decompress(self.pending, self.read_size)
+            self.pending = d.unconsumed_tail
+            if d.eof:
+                # Concatenated gzip members, unused_data holds all the input after this one
+                self.pending = d.unused_data
+                d = self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if self.buffer:
+                break
+        if self.checkpoint_interval:
+            end = self.buffer_start + len(self.buffer)
+            last = self.checkpoints[-1][0] if self.checkpoints else 0
+            if end - last >= self.checkpoint_interval:
+                self.checkpoints.append((end, self.file.tell() - len(self.pending), d.copy()))
+        return True
+
+    def read(self, n=-1):
+        if self.seek_to is not None:
+            self.move(self.seek_to)
+        offset = self.offset
+        if 0 <= n <= len(self.buffer) - offset:
+            self.offset = offset + n
+            return self.buffer[offset:offset + n]
+        chunks = [self.buffer[offset:]]
+        remaining = n - len(chunks[0])
+        while (n < 0 or remaining > 0) and self.fill():
+            chunk = self.buffer if n < 0 else self.buffer[:remaining]
+            self.offset = len(chunk)
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def seek(self, n, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            n += self.tell()
+        elif whence == os.SEEK_END:
+            raise ValueError('Cannot seek from the end of a compressed file')
+        self.seek_to = n
+        return n
+
+    def move(self, n):
+        self.seek_to = None
+        if n < self.buffer_start:
+            i = bisect.bisect_right(self.checkpoints, (n, float('inf'))) - 1
+            self.restart(self.checkpoints[i] if i >= 0 else None)
+        while n > self.buffer_start + len(self.buffer):
+            if not self.fill():
+                break
+        self.offset = min(n - self.buffer_start, len(self.buffer))
+
+    def tell(self):
+        if self.seek_to is not None:
+            return self.seek_to
+        return self.buffer_start + self.offset
+
+    def close(self):
+        self.file.close()
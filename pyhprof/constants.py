@@ -44,6 +44,21 @@ OBJECT_TYPES = {
     11: 'LONG'
 }
 
+OBJECT_TYPE_CODES = dict((tp, code) for code, tp in OBJECT_TYPES.items())
+
+# struct format codes for values of each type, with 'O' standing in for an identifier
+TYPE_STRUCT_CODES = {
+    'OBJECT': 'O',
+    'BOOLEAN': 'B',
+    'CHAR': 'H',
+    'FLOAT': 'f',
+    'DOUBLE': 'd',
+    'BYTE': 'B',
+    'SHORT': 'H',
+    'INT': 'I',
+    'LONG': 'Q'
+}
+
 TYPE_SIZES = {
     'BOOLEAN': 1,
     'CHAR': 2,
@@ -0,0 +1,272 @@
+"""Differences between two heap dumps of the same JVM, computed by streaming through both
+without building any references.
+"""
+
+import mmap
+import tempfile
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from heapq import merge
+
+from .constants import OBJECT_TYPES
+from .histogram import ClassHistogram, read_strings
+from .parsers import HProfParser, HeapDumpParser, ID_CODES
+from .references import InstanceLayout
+
+# Fields holding the number of elements of a collection, the first one found is used
+SIZE_FIELD_NAMES = ('size', 'elementCount', 'count')
+
+
+class IdSet(object):
+    """Set of object ids, added once each, keeping at most `max_ids` of them in memory.
+    Beyond that they are sorted and spilled to temporary files in `dir`, which are
+    memory mapped and binary searched by lookups
+    """
+
+    def __init__(self, id_code='Q', max_ids=2 ** 22, dir=None):
+        self.id_code = id_code
+        self.max_ids = max_ids
+        self.dir = dir
+        self.ids = array(id_code)
+        self.unsorted = False
+        # Sorted runs spilled to disk, and their files and mappings
+        self.runs = []
+        self.files = []
+
+    def add(self, id):
+        self.ids.append(id)
+        self.unsorted = True
+        if len(self.ids) >= self.max_ids:
+            self.spill()
+
+    def spill(self):
+        if not self.ids:
+            return
+        f = tempfile.TemporaryFile(dir=self.dir)
+        array(self.id_code, sorted(self.ids)).tofile(f)
+        f.flush()
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.files.append((f, m))
+        self.runs.append(memoryview(m).cast(self.id_code))
+        self.ids = array(self.id_code)
+        self.unsorted = False
+
+    def sorted_ids(self):
+        if self.unsorted:
+            self.ids = array(self.id_code, sorted(self.ids))
+            self.unsorted = False
+        return self.ids
+
+    def __contains__(self, id):
+        ids = self.sorted_ids()
+        i = bisect_left(ids, id)
+        if i < len(ids) and ids[i] == id:
+            return True
+        for run in self.runs:
+            i = bisect_left(run, id)
+            if i < len(run) and run[i] == id:
+                return True
+        return False
+
+    def __len__(self):
+        return len(self.ids) + sum(len(run) for run in self.runs)
+
+    def __iter__(self):
+        """The ids in ascending order
+        """
+        return merge(self.sorted_ids(), *self.runs)
+
+    def close(self):
+        for run in self.runs:
+            run.release()
+        for f, m in self.files:
+            m.close()
+            f.close()
+        self.runs = []
+        self.files = []
+        self.ids = array(self.id_code)
+
+
+class DumpSummary(object):
+    """Class histogram of a dump and the sizes of its instances of some collection classes,
+    read in one pass over its heap dump headers like ClassHistogram.read.
+
+    `collection_sizes` maps the ids of the watched collections to their (class name,
+    size): the value of their first field named in SIZE_FIELD_NAMES, or their length for
+    object arrays.
+    """
+
+    def __init__(self, histogram, collection_sizes):
+        self.histogram = histogram
+        self.collection_sizes = collection_sizes
+
+    @classmethod
+    def read(cls, f, use_mmap=False, collections=(), visit=None):
+        """Summarise a dump, calling `visit(id, class key, size)` for every instance and array,
+        keyed as in ClassHistogram. `collections` are the class names to watch
+        """
+        return cls.build(HProfParser(f, use_mmap), collections, visit)
+
+    @classmethod
+    def build(cls, p, collections=(), visit=None):
+        """read, from an HProfParser of the dump
+        """
+        class_name_ids = {}
+        heap_dumps = []
+        for b in p:
+            if b.tag_name == 'HEAP_DUMP' or b.tag_name == 'HEAP_DUMP_SEGMENT':
+                heap_dumps.append((b.start, b.length))
+            elif b.tag_name == 'LOAD_CLASS':
+                class_name_ids[b.class_id] = b.class_name_id
+
+        strings = read_strings(p, set(class_name_ids.values()))
+        names = dict((id, strings.get(name_id)) for id, name_id in class_name_ids.items())
+        collections = set(name.replace('.', '/') for name in collections)
+        watched = set(id for id, name in names.items() if name and name.replace('.', '/') in collections)
+
+        counts = Counter()
+        sizes = Counter()
+        class_fields = {}
+        # (class id, size) of watched arrays and (class id, data) of watched instances
+        arrays = {}
+        instances = {}
+
+        def watch_instance(id, class_id, data):
+            instances[id] = (class_id, bytes(data))
+
+        def watch_array(id, class_id, n_elements, offset):
+            arrays[id] = (class_id, n_elements)
+
+        def class_dump(c, start):
+            class_fields[c.id] = (c.super_class_id, c.instance_fields)
+
+        for start, length in heap_dumps:
+            with p.goto(start):
+                ClassHistogram.count_heap_dump(HeapDumpParser(p.f, p.id_size, length), counts, sizes, visit,
+                                               watched, watch_instance, watch_array, class_dump)
+
+        collection_sizes = dict((id, (names.get(class_id), size)) for id, (class_id, size) in arrays.items())
+        if instances:
+            # Another pass over the records reads the field names of the watched classes
+            wanted = set()
+            for class_id in watched:
+                while class_id in class_fields:
+                    class_id, instance_fields = class_fields[class_id]
+                    wanted.update(name_id for name_id, tp in instance_fields)
+            strings.update(read_strings(p, wanted))
+            layouts = {}
+            for id, (class_id, data) in instances.items():
+                if class_id not in layouts:
+                    layouts[class_id] = cls.size_layout(p, strings, class_fields, class_id)
+                layout, i = layouts[class_id]
+                if layout is not None and layout.struct.size == len(data):
+                    collection_sizes[id] = (names.get(class_id), layout.struct.unpack(data)[i])
+
+        names.update((tp, '%s[]' % tp.lower()) for tp in OBJECT_TYPES.values())
+        return cls(ClassHistogram(counts, sizes, names), collection_sizes)
+
+    @staticmethod
+    def size_layout(p, strings, class_fields, class_id):
+        """(InstanceLayout, index of the size field) of a class, or (None, None) if its
+        hierarchy is not dumped or it has no size field
+        """
+        fields = []
+        c = class_id
+        while c:
+            if c not in class_fields:
+                return None, None
+            c, instance_fields = class_fields[c]
+            fields.extend(instance_fields)
+        names = [strings.get(name_id) for name_id, tp in fields]
+        for name in SIZE_FIELD_NAMES:
+            if name in names:
+                i = names.index(name)
+                break
+        else:
+            return None, None
+        try:
+            return InstanceLayout(p.structs, strings, fields), i
+        except KeyError:
+            # An object field's name is not in the dump
+            return None, None
+
+
+class HeapDiff(object):
+    """Changes between an older and a newer dump of the same JVM, by class name (summing
+    the classes of different class loaders).
+
+    `old` and `new` are the ClassHistograms of the two dumps, and `added` that of the
+    objects of the newer dump whose ids are not in the older one, which `added_ids` (an
+    IdSet) holds. Ids are object addresses, so `added` is only meaningful when the JVM
+    kept them stable between the dumps. `growth` lists (id, class name, old size, new
+    size) for the watched collections found in both dumps whose size changed, the most
+    grown first.
+    """
+
+    def __init__(self, old, new, added, added_ids, growth):
+        self.old = old
+        self.new = new
+        self.added = added
+        self.added_ids = added_ids
+        self.growth = growth
+
+    @classmethod
+    def read(cls, old_f, new_f, use_mmap=False, collections=(), max_ids=2 ** 22, dir=None):
+        """Compare two dumps in one pass over the heap dump headers of each. Memory use is
+        proportional to the number of classes and watched `collections` (class names, see
+        DumpSummary), with at most `max_ids` object ids of each dump held in memory and the
+        rest spilled to temporary files in `dir`
+        """
+        old_p = HProfParser(old_f, use_mmap)
+        old_ids = IdSet(ID_CODES[old_p.id_size], max_ids, dir)
+        old = DumpSummary.build(old_p, collections, lambda id, key, size: old_ids.add(id))
+
+        new_p = HProfParser(new_f, use_mmap)
+        added_ids = IdSet(ID_CODES[new_p.id_size], max_ids, dir)
+        added_counts = Counter()
+        added_sizes = Counter()
+
+        def visit(id, key, size):
+            if id not in old_ids:
+                added_ids.add(id)
+                added_counts[key] += 1
+                added_sizes[key] += size
+
+        try:
+            new = DumpSummary.build(new_p, collections, visit)
+        finally:
+            old_ids.close()
+        added = ClassHistogram(added_counts, added_sizes, new.histogram.names).by_name()
+
+        growth = []
+        for id, (name, new_size) in new.collection_sizes.items():
+            if id in old.collection_sizes:
+                old_size = old.collection_sizes[id][1]
+                if new_size != old_size:
+                    growth.append((id, name, old_size, new_size))
+        growth.sort(key=lambda row: (row[2] - row[3], row[0]))
+        return cls(old.histogram.by_name(), new.histogram.by_name(), added, added_ids, growth)
+
+    def rows(self):
+        """(class name, count delta, bytes delta, added count, added bytes) of every class
+        whose count or size changed or that has added objects, largest byte growth first
+        """
+        rows = []
+        for name in set(self.old.counts) | set(self.new.counts):
+            count = self.new.counts[name] - self.old.counts[name]
+            size = self.new.sizes[name] - self.old.sizes[name]
+            if count or size or self.added.counts[name]:
+                rows.append((name, count, size, self.added.counts[name], self.added.sizes[name]))
+        return sorted(rows, key=lambda row: (-row[2], row[0]))
+
+    def __str__(self):
+        lines = ['%12s %14s %12s %14s  %s' % ('instances', 'bytes', 'added', 'added bytes', 'class')]
+        lines.extend('%+12d %+14d %12d %14d  %s' % (count, size, added, added_size, name)
+                     for name, count, size, added, added_size in self.rows())
+        if self.growth:
+            lines.append('')
+            lines.append('%20s %12s %12s  %s' % ('collection', 'old size', 'new size', 'class'))
+            lines.extend('%#20x %12d %12d  %s' % (id, old_size, new_size, name)
+                         for id, name, old_size, new_size in self.growth)
+        return '\n'.join(lines)
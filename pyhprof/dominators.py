@@ -0,0 +1,172 @@
+"""Dominator tree of the object graph and the retained size of every object.
+
+An object A dominates B if every path from the GC roots to B passes through A, so the
+retained size of A, the memory freed if A were collected, is the total shallow size
+of the objects it dominates.
+"""
+
+from array import array
+from heapq import nlargest
+
+# idom values for objects only dominated by the virtual root above all GC roots, and for
+# objects that are not reachable from any root
+ROOT = -1
+UNREACHABLE = -2
+
+
+class DominatorTree(object):
+    """Immediate dominators and retained sizes of the objects in an ObjectGraph.
+
+    Computed in one pass with the Lengauer-Tarjan algorithm (simple version, with path
+    compression) from a virtual root whose successors are the graph's root rows.
+    `idom[i]` is the row of the immediate dominator of row i, or ROOT or UNREACHABLE, and
+    `retained[i]` its retained size in bytes.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.store = graph.store
+        self.compute()
+
+    def compute(self):
+        graph = self.graph
+        n = graph.n
+        targets = graph.targets
+        edge_offsets = graph.edge_offsets
+        roots = graph.root_rows
+
+        # Depth first numbering from the virtual root. Node v is row v - 1, node 0 the
+        # virtual root, and dfnum/vertex/parent translate to and from dfs numbers 1..count
+        dfnum = array('l', [0]) * (n + 1)
+        vertex = array('l', [0]) * (n + 2)
+        parent = array('l', [0]) * (n + 2)
+        count = 1
+        dfnum[0] = 1
+        stack = [(0, 0, len(roots))]
+        while stack:
+            v, pos, end = stack[-1]
+            while pos < end:
+                w = (roots[pos] if v == 0 else targets[pos]) + 1
+                pos += 1
+                if w > 0 and not dfnum[w]:
+                    stack[-1] = (v, pos, end)
+                    count += 1
+                    dfnum[w] = count
+                    vertex[count] = w
+                    parent[count] = dfnum[v]
+                    stack.append((w, edge_offsets[w - 1], edge_offsets[w]))
+                    break
+            else:
+                stack.pop()
+
+        # Predecessors in dfs numbers, as CSR arrays
+        pred_offsets = array('l', [0]) * (count + 2)
+        for d in range(1, count + 1):
+            v = vertex[d]
+            for w in (roots if v == 0 else targets[edge_offsets[v - 1]:edge_offsets[v]]):
+                if w >= 0 and dfnum[w + 1]:
+                    pred_offsets[dfnum[w + 1] + 1] += 1
+        for d in range(1, count + 2):
+            pred_offsets[d] += pred_offsets[d - 1]
+        preds = array('l', [0]) * pred_offsets[count + 1]
+        fill = array('l', pred_offsets)
+        for d in range(1, count + 1):
+            v = vertex[d]
+            for w in (roots if v == 0 else targets[edge_offsets[v - 1]:edge_offsets[v]]):
+                if w >= 0 and dfnum[w + 1]:
+                    x = dfnum[w + 1]
+                    preds[fill[x]] = d
+                    fill[x] += 1
+        del fill
+
+        semi = array('l', range(count + 1))
+        label = array('l', range(count + 1))
+        ancestor = array('l', [0]) * (count + 1)
+        idom = array('l', [0]) * (count + 1)
+        bucket_head = array('l', [0]) * (count + 1)
+        bucket_next = array('l', [0]) * (count + 1)
+
+        def evaluate(v):
+            if not ancestor[v]:
+                return v
+            path = []
+            while ancestor[ancestor[v]]:
+                path.append(v)
+                v = ancestor[v]
+            for x in reversed(path):
+                a = ancestor[x]
+                if semi[label[a]] < semi[label[x]]:
+                    label[x] = label[a]
+                ancestor[x] = ancestor[a]
+            return label[path[0]] if path else label[v]
+
+        for w in range(count, 1, -1):
+            for i in range(pred_offsets[w], pred_offsets[w + 1]):
+                u = evaluate(preds[i])
+                if semi[u] < semi[w]:
+                    semi[w] = semi[u]
+            s = semi[w]
+            bucket_next[w] = bucket_head[s]
+            bucket_head[s] = w
+            p = parent[w]
+            ancestor[w] = p
+            v = bucket_head[p]
+            while v:
+                u = evaluate(v)
+                idom[v] = u if semi[u] < semi[v] else p
+                v = bucket_next[v]
+            bucket_head[p] = 0
+        for w in range(2, count + 1):
+            if idom[w] != semi[w]:
+                idom[w] = idom[idom[w]]
+
+        sizes = self.store.sizes
+        retained = array('Q', [0]) * (count + 1)
+        for d in range(2, count + 1):
+            retained[d] = sizes[vertex[d] - 1]
+        for d in range(count, 2, -1):
+            retained[idom[d]] += retained[d]
+
+        self.idom = array('l', [UNREACHABLE]) * n
+        self.retained = array('Q', [0]) * n
+        for d in range(2, count + 1):
+            row = vertex[d] - 1
+            self.idom[row] = vertex[idom[d]] - 1 if idom[d] > 1 else ROOT
+            self.retained[row] = retained[d]
+
+    def row(self, id):
+        i = self.store.index(id)
+        if i < 0:
+            raise KeyError(id)
+        return i
+
+    def retained_size(self, id):
+        """Bytes retained by an object, None if it is not reachable from the GC roots
+        """
+        i = self.row(id)
+        if self.idom[i] == UNREACHABLE:
+            return None
+        return self.retained[i]
+
+    def immediate_dominator(self, id):
+        """Id of the object's immediate dominator, None if it is dominated only by the
+        GC roots as a whole or is unreachable
+        """
+        d = self.idom[self.row(id)]
+        if d < 0:
+            return None
+        return self.store.ids[d]
+
+    def dominated(self, id):
+        """Ids of the objects immediately dominated by an object
+        """
+        i = self.row(id)
+        ids = self.store.ids
+        return [ids[j] for j in range(len(self.idom)) if self.idom[j] == i]
+
+    def top_retainers(self, n=10):
+        """The n reachable objects with the largest retained sizes, as (id, retained size)
+        """
+        rows = nlargest(n, range(len(self.retained)), key=self.retained.__getitem__)
+        ids = self.store.ids
+        return [(ids[i], self.retained[i]) for i in rows if self.idom[i] != UNREACHABLE]
@@ -0,0 +1,109 @@
+"""Dense, row indexed view of the object graph held in an ObjectStore, for analyses
+that walk the whole heap.
+"""
+
+from array import array
+
+
+class ObjectGraph(object):
+    """Outgoing references of every object as store row numbers in CSR form, plus the
+    rows held by GC roots.
+
+    `targets[edge_offsets[i]:edge_offsets[i + 1]]` are the rows referenced by row i, with
+    -1 for null or dangling references. `root_rows` are the distinct rows named by GC root
+    records, followed by those referenced from static fields of the classes passed in.
+    """
+
+    def __init__(self, store, classes=None):
+        self.store = store
+        self.n = len(store)
+        self.edge_offsets = store.edge_offsets
+        index = store.index
+        self.targets = array('l', map(index, store.edges))
+
+        seen = set()
+        self.root_rows = array('l')
+        for id in store.root_ids:
+            row = index(id)
+            if row >= 0 and row not in seen:
+                seen.add(row)
+                self.root_rows.append(row)
+        for c in (classes or {}).values():
+            for name_id, tp, value in c.static_fields:
+                if tp == 'OBJECT' and value:
+                    row = index(value)
+                    if row >= 0 and row not in seen:
+                        seen.add(row)
+                        self.root_rows.append(row)
+
+    def successors(self, i):
+        return self.targets[self.edge_offsets[i]:self.edge_offsets[i + 1]]
+
+
+class ReverseGraph(object):
+    """Inbound references of every object in an ObjectGraph, in CSR form.
+
+    The referrers of row i are `referrers[offsets[i]:offsets[i + 1]]`, in row order, and
+    `slots` holds the position of each reference among the referrer's outgoing
+    references: the index of an object array element, or of an object field in its
+    InstanceLayout. `field_names(class_id)`, if given, names the object fields of a
+    class's instances, in that order. Rows and slots take 4 bytes each.
+    """
+
+    def __init__(self, graph, field_names=None):
+        self.graph = graph
+        self.store = graph.store
+        self.field_names = field_names
+        n = graph.n
+        targets = graph.targets
+        edge_offsets = graph.edge_offsets
+
+        offsets = array('l', [0]) * (n + 1)
+        for t in targets:
+            if t >= 0:
+                offsets[t + 1] += 1
+        for i in range(1, n + 1):
+            offsets[i] += offsets[i - 1]
+        referrers = array('i', [0]) * offsets[n]
+        slots = array('I', [0]) * offsets[n]
+        fill = array('l', offsets)
+        for row in range(n):
+            start = edge_offsets[row]
+            for e in range(start, edge_offsets[row + 1]):
+                t = targets[e]
+                if t >= 0:
+                    position = fill[t]
+                    referrers[position] = row
+                    slots[position] = e - start
+                    fill[t] += 1
+        self.offsets = offsets
+        self.referrers = referrers
+        self.slots = slots
+
+    def referrer_rows(self, i):
+        return self.referrers[self.offsets[i]:self.offsets[i + 1]]
+
+    def label(self, row, slot):
+        """Field name or '[index]' of a referrer's reference, None if unknown
+        """
+        store = self.store
+        if store.kind(row) == 'OBJECT_ARRAY_DUMP':
+            return '[%d]' % slot
+        if self.field_names is None:
+            return None
+        names = self.field_names(store.class_id(row))
+        return names[slot] if names is not None and slot < len(names) else None
+
+    def referrers_of(self, id):
+        """(referrer id, label) of every reference to an object
+        """
+        i = self.store.index(id)
+        if i < 0:
+            raise KeyError(id)
+        ids = self.store.ids
+        return [(ids[self.referrers[k]], self.label(self.referrers[k], self.slots[k]))
+                for k in range(self.offsets[i], self.offsets[i + 1])]
+
+    @property
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.offsets, self.referrers, self.slots))
@@ -1,83 +1,101 @@
+from .constants import OBJECT_TYPES
+
+
 class BaseHeapDumpBlock(object):
+    # Records are built by the million, so none of them has a __dict__
+    __slots__ = ('id',)
+
+    # Fixed record layout (see parsers.RecordStructs) of blocks that parse straight into __init__
+    layout = None
+
     def __init__(self, id):
         self.id = id
 
-
-class BaseOnlyIdHeapDumpBlock(BaseHeapDumpBlock):
     @classmethod
     def parse(cls, p):
-        return cls(p.read_id())
+        return cls(*p.unpack(p.structs[cls.layout]))
+
+    @classmethod
+    def skip(cls, p):
+        """Move the parser past a record of this type without building it
+        """
+        p.seek(p.structs[cls.layout].size)
+
+
+class BaseOnlyIdHeapDumpBlock(BaseHeapDumpBlock):
+    __slots__ = ()
+    layout = '>O'
 
 
 class BaseThreadHeapDumpBlock(BaseHeapDumpBlock):
+    __slots__ = ('thread_serial_number',)
+    layout = '>OI'
+
     def __init__(self, id, thread_serial_number):
         super(BaseThreadHeapDumpBlock, self).__init__(id)
         self.thread_serial_number = thread_serial_number
 
-    @classmethod
-    def parse(cls, p):
-        return cls(p.read_id(), p.i4())
-
 
 class BaseThreadFrameHeadDumpBlock(BaseThreadHeapDumpBlock):
+    __slots__ = ('frame_number',)
+    layout = '>OII'
+
     def __init__(self, id, thread_serial_number, frame_number):
         super(BaseThreadFrameHeadDumpBlock, self).__init__(id, thread_serial_number)
         self.frame_number = frame_number
 
-    @classmethod
-    def parse(cls, p):
-        return cls(p.read_id(), p.i4(), p.i4())
-
 
 class RootUnknown(BaseOnlyIdHeapDumpBlock):
-    pass
+    __slots__ = ()
 
 
 class RootJniGlobal(BaseHeapDumpBlock):
+    __slots__ = ('jni_global_ref',)
+    layout = '>OO'
+
     def __init__(self, id, jni_global_ref):
         super(RootJniGlobal, self).__init__(id)
         self.jni_global_ref = jni_global_ref
 
-    @classmethod
-    def parse(cls, p):
-        return cls(p.read_id(), p.read_id())
-
 
 class RootJniLocal(BaseThreadFrameHeadDumpBlock):
-    pass
+    __slots__ = ()
 
 
 class RootJavaFrame(BaseThreadFrameHeadDumpBlock):
-    pass
+    __slots__ = ()
 
 
 class RootNativeStack(BaseThreadHeapDumpBlock):
-    pass
+    __slots__ = ()
 
 
 class RootStickyClass(BaseOnlyIdHeapDumpBlock):
-    pass
+    __slots__ = ()
 
 
 class RootThreadBlock(BaseThreadHeapDumpBlock):
-    pass
+    __slots__ = ()
 
 
 class RootMonitorUsed(BaseOnlyIdHeapDumpBlock):
-    pass
+    __slots__ = ()
 
 
 class RootThreadObject(BaseThreadHeapDumpBlock):
+    __slots__ = ('stack_trace_serial_number',)
+    layout = '>OII'
+
     def __init__(self, id, thread_serial_number, stack_trace_serial_number):
         super(RootThreadObject, self).__init__(id, thread_serial_number)
         self.stack_trace_serial_number = stack_trace_serial_number
 
-    @classmethod
-    def parse(cls, p):
-        return cls(p.read_id(), p.i4(), p.i4())
-
 
 class ClassDump(BaseHeapDumpBlock):
+    __slots__ = ('stack_trace_serial_number', 'super_class_id', 'class_loader_id', 'signers_object_id',
+                 'protection_domain_object_id', 'reserved1', 'reserved2', 'instance_size',
+                 'constants_pool', 'static_fields', 'instance_fields')
+
     def __init__(self,
                  id,
                  stack_trace_serial_number,
@@ -92,21 +110,24 @@ class ClassDump(BaseHeapDumpBlock):
                  static_fields,
                  instance_fields):
         super(ClassDump, self).__init__(id)
-        vars(self).update(locals())
-        del self.self
+        self.stack_trace_serial_number = stack_trace_serial_number
+        self.super_class_id = super_class_id
+        self.class_loader_id = class_loader_id
+        self.signers_object_id = signers_object_id
+        self.protection_domain_object_id = protection_domain_object_id
+        self.reserved1 = reserved1
+        self.reserved2 = reserved2
+        self.instance_size = instance_size
+        self.constants_pool = constants_pool
+        self.static_fields = static_fields
+        self.instance_fields = instance_fields
 
     @classmethod
     def parse(cls, p):
-        id = p.read_id()
-        stack_trace_serial_number = p.i4()
-        super_class_id = p.read_id()
-        class_loader_id = p.read_id()
-        signers_object_id = p.read_id()
-        protection_domain_object_id = p.read_id()
-        reserved1 = p.read_id()
-        reserved2 = p.read_id()
-        instance_size = p.i4()
-        constants = [cls.read_constant(p) for _ in range(p.i2())]
+        (id, stack_trace_serial_number, super_class_id, class_loader_id, signers_object_id,
+         protection_domain_object_id, reserved1, reserved2, instance_size,
+         n_constants) = p.unpack(p.structs['>OIOOOOOOIH'])
+        constants = [cls.read_constant(p) for _ in range(n_constants)]
         static_fields = [cls.read_static_field(p) for _ in range(p.i2())]
         instance_fields = [cls.read_instance_field(p) for _ in range(p.i2())]
 
@@ -117,25 +138,35 @@ class ClassDump(BaseHeapDumpBlock):
     @classmethod
     def read_constant(cls, p):
         pool_index = p.i2()
-        tp = p.read_value_type()
-        value = p.read_value(tp)
+        tp, value = p.read_typed_value()
         return [pool_index, tp, value]
 
     @classmethod
     def read_static_field(cls, p):
         name_id = p.read_id()
-        tp = p.read_value_type()
-        value = p.read_value(tp)
+        tp, value = p.read_typed_value()
         return [name_id, tp, value]
 
     @classmethod
     def read_instance_field(cls, p):
-        name_id = p.read_id()
-        tp = p.read_value_type()
-        return [name_id, tp]
+        name_id, code = p.unpack(p.structs['>OB'])
+        return [name_id, OBJECT_TYPES[code]]
+
+    @classmethod
+    def skip(cls, p):
+        p.seek(p.structs['>OIOOOOOOI'].size)
+        for _ in range(p.i2()):
+            p.seek(2)
+            p.seek(p.value_sizes[p.i1()])
+        for _ in range(p.i2()):
+            p.seek(p.id_size)
+            p.seek(p.value_sizes[p.i1()])
+        p.seek(p.i2() * (p.id_size + 1))
 
 
 class InstanceDump(BaseHeapDumpBlock):
+    __slots__ = ('stack_trace_serial_number', 'class_object_id', 'bytes')
+
     def __init__(self, id, stack_trace_serial_number, class_object_id, bytes):
         super(InstanceDump, self).__init__(id)
         self.stack_trace_serial_number = stack_trace_serial_number
@@ -144,15 +175,21 @@ class InstanceDump(BaseHeapDumpBlock):
 
     @classmethod
     def parse(cls, p):
-        id = p.read_id()
-        stack_trace_serial_number = p.i4()
-        class_object_id = p.read_id()
-        n_bytes = p.i4()
+        id, stack_trace_serial_number, class_object_id, n_bytes = p.unpack(p.structs['>OIOI'])
         bytes = p.read(n_bytes)
         return cls(id, stack_trace_serial_number, class_object_id, bytes)
 
+    @classmethod
+    def skip(cls, p):
+        p.seek(p.unpack(p.structs['>OIOI'])[3])
+
 
 class ObjectArrayDump(BaseHeapDumpBlock):
+    """An object array, whose `elements` are a typed array of ids
+    """
+
+    __slots__ = ('stack_trace_serial_number', 'array_class_object_id', 'elements')
+
     def __init__(self, id, stack_trace_serial_number, array_class_object_id, elements):
         super(ObjectArrayDump, self).__init__(id)
         self.stack_trace_serial_number = stack_trace_serial_number
@@ -161,35 +198,45 @@ class ObjectArrayDump(BaseHeapDumpBlock):
 
     @classmethod
     def parse(cls, p):
-        id = p.read_id()
-        stack_trace_serial_number = p.i4()
-        n_elements = p.i4()
-        array_class_object_id = p.read_id()
-        elements = [p.read_id() for _ in range(n_elements)]
+        id, stack_trace_serial_number, n_elements, array_class_object_id = p.unpack(p.structs['>OIIO'])
+        elements = p.read_id_array(n_elements)
 
         return cls(id, stack_trace_serial_number, array_class_object_id, elements)
 
+    @classmethod
+    def skip(cls, p):
+        p.seek(p.unpack(p.structs['>OII'])[2] * p.id_size + p.id_size)
+
 
 class PrimitiveArrayDump(BaseHeapDumpBlock):
-    def __init__(self, id, stack_trace_serial_number, element_type, size, data):
+    __slots__ = ('stack_trace_serial_number', 'element_type', 'size', 'data', 'data_offset')
+
+    def __init__(self, id, stack_trace_serial_number, element_type, size, data, data_offset=None):
         super(PrimitiveArrayDump, self).__init__(id)
         self.stack_trace_serial_number = stack_trace_serial_number
         self.element_type = element_type
         self.size = size
         self.data = data
-
+        self.data_offset = data_offset
 
     @classmethod
     def parse(cls, p):
-        id = p.read_id()
-        stack_trace_serial_number = p.i4()
-        size = p.i4()
-        element_type = p.read_value_type()
-        data = p.read(p.type_size(element_type) * size)
-        # By reading the data you can get the same effect, and also get the value
-        # p.seek(p.type_size(element_type) * size)
+        id, stack_trace_serial_number, size, code = p.unpack(p.structs['>OIIB'])
+        element_type = OBJECT_TYPES[code]
+        n_bytes = p.value_sizes[code] * size
+        if p.lazy_payloads:
+            # Only remember where the data is, see payloads.PayloadLoader
+            data_offset = p.tell()
+            p.seek(n_bytes)
+            return cls(id, stack_trace_serial_number, element_type, size, None, data_offset)
+        data = p.read(n_bytes)
         return cls(id, stack_trace_serial_number, element_type, size, data)
 
+    @classmethod
+    def skip(cls, p):
+        _, _, size, code = p.unpack(p.structs['>OIIB'])
+        p.seek(size * p.value_sizes[code])
+
 
 HEAP_BLOCK_CLASSES_BY_TAG = {
     'ROOT_UNKNOWN': RootUnknown,
@@ -206,3 +253,5 @@ HEAP_BLOCK_CLASSES_BY_TAG = {
     'OBJECT_ARRAY_DUMP': ObjectArrayDump,
     'PRIMITIVE_ARRAY_DUMP': PrimitiveArrayDump
 }
+
+ROOT_TAGS_BY_CLASS = dict((cls, tag) for tag, cls in HEAP_BLOCK_CLASSES_BY_TAG.items() if tag.startswith('ROOT_'))
@@ -0,0 +1,251 @@
+"""Class histogram of a heap dump: how many objects of each class there are and how much
+memory they take, computed without building any objects.
+"""
+
+import struct
+from collections import Counter
+
+from .constants import OBJECT_TYPES, ARRAY_OVERHEAD
+from .heap_blocks import ClassDump
+from .parsers import HProfParser, HeapDumpParser, HEAP_BLOCK_CLASSES_BY_CODE, U1
+from .store import KIND_CODES
+
+CLASS_DUMP = KIND_CODES['CLASS_DUMP']
+INSTANCE_DUMP = KIND_CODES['INSTANCE_DUMP']
+OBJECT_ARRAY_DUMP = KIND_CODES['OBJECT_ARRAY_DUMP']
+PRIMITIVE_ARRAY_DUMP = KIND_CODES['PRIMITIVE_ARRAY_DUMP']
+
+
+def read_strings(p, wanted):
+    """{id: text} of the STRING records whose ids are in `wanted`, in a pass over the
+    records that only reads the ids of the others
+    """
+    strings = {}
+    with p.goto(p.first_record):
+        for b in p:
+            if b.tag_name == 'STRING':
+                with p.goto(b.start):
+                    if p.read_id() not in wanted:
+                        continue
+                strings[b.id] = b.contents
+    return strings
+
+
+class ClassHistogram(object):
+    """Object counts and shallow sizes per class.
+
+    `counts` and `sizes` are keyed by class id for instances and object arrays, and by
+    element type name for primitive arrays. Sizes are those of the references built by
+    ReferenceBuilder. `names` maps the keys to class names.
+    """
+
+    def __init__(self, counts, sizes, names):
+        self.counts = counts
+        self.sizes = sizes
+        self.names = names
+
+    @classmethod
+    def read(cls, f, use_mmap=False):
+        """Read the histogram of a dump in one pass over its heap dump headers, seeking past
+        all instance and array contents. Memory use is proportional to the number of classes
+        """
+        p = HProfParser(f, use_mmap)
+        class_name_ids = {}
+        heap_dumps = []
+        for b in p:
+            if b.tag_name == 'HEAP_DUMP' or b.tag_name == 'HEAP_DUMP_SEGMENT':
+                heap_dumps.append((b.start, b.length))
+            elif b.tag_name == 'LOAD_CLASS':
+                class_name_ids[b.class_id] = b.class_name_id
+
+        counts = Counter()
+        sizes = Counter()
+        for start, length in heap_dumps:
+            with p.goto(start):
+                cls.count_heap_dump(HeapDumpParser(p.f, p.id_size, length), counts, sizes)
+
+        # A second pass over the records reads only the strings naming classes
+        strings = read_strings(p, set(class_name_ids.values()))
+        names = dict((id, strings.get(name_id)) for id, name_id in class_name_ids.items())
+        names.update((tp, '%s[]' % tp.lower()) for tp in OBJECT_TYPES.values())
+        return cls(counts, sizes, names)
+
+    @staticmethod
+    def count_heap_dump(p, counts, sizes, visit=None, watched=(), watch_instance=None, watch_array=None,
+                        class_dump=None, record=None):
+        """Count the instances and arrays of a heap dump into `counts` and `sizes`, seeking past
+        their contents. Other passes over the headers hook in with callbacks:
+
+        - `visit(id, key, size)` for every instance and array, keyed as in the histogram
+        - `watch_instance(id, class id, data)` for the instances of the classes in `watched`
+        - `watch_array(id, key, length, offset)` for the arrays whose key is in `watched`, with
+          the file offset of their contents
+        - `class_dump(ClassDump, start)` for every class dump
+        - `record(tag, id, key, start)` for every instance and array
+
+        where `start` is the file offset of the sub-record
+        """
+        if p.mapped:
+            return ClassHistogram.count_mapped_heap_dump(p, counts, sizes, visit, watched, watch_instance,
+                                                         watch_array, class_dump, record)
+        f = p.f
+        end = float('inf') if p.length is None else p.base + p.length
+        id_size = p.id_size
+        value_sizes = p.value_sizes
+        instance_header = p.structs['>OIOI']
+        object_array_header = p.structs['>OIIO']
+        primitive_array_header = p.structs['>OIIB']
+        try:
+            start = f.tell()
+            while start < end:
+                tag = p.unpack(U1)[0]
+                if tag == INSTANCE_DUMP:
+                    id, _, class_id, n_bytes = p.unpack(instance_header)
+                    if record is not None:
+                        record(tag, id, class_id, start)
+                    if class_id in watched:
+                        watch_instance(id, class_id, p.read(n_bytes))
+                    else:
+                        p.seek(n_bytes)
+                    counts[class_id] += 1
+                    sizes[class_id] += n_bytes
+                    if visit is not None:
+                        visit(id, class_id, n_bytes)
+                elif tag == OBJECT_ARRAY_DUMP:
+                    id, _, n_elements, class_id = p.unpack(object_array_header)
+                    if record is not None:
+                        record(tag, id, class_id, start)
+                    if class_id in watched:
+                        watch_array(id, class_id, n_elements, f.tell())
+                    p.seek(n_elements * id_size)
+                    size = ARRAY_OVERHEAD + n_elements * id_size
+                    counts[class_id] += 1
+                    sizes[class_id] += size
+                    if visit is not None:
+                        visit(id, class_id, size)
+                elif tag == PRIMITIVE_ARRAY_DUMP:
+                    id, _, n_elements, code = p.unpack(primitive_array_header)
+                    tp = OBJECT_TYPES[code]
+                    if record is not None:
+                        record(tag, id, tp, start)
+                    if tp in watched:
+                        watch_array(id, tp, n_elements, f.tell())
+                    n_bytes = n_elements * value_sizes[code]
+                    p.seek(n_bytes)
+                    counts[tp] += 1
+                    sizes[tp] += ARRAY_OVERHEAD + n_bytes
+                    if visit is not None:
+                        visit(id, tp, ARRAY_OVERHEAD + n_bytes)
+                elif tag == CLASS_DUMP and class_dump is not None:
+                    class_dump(ClassDump.parse(p), start)
+                else:
+                    block_class = HEAP_BLOCK_CLASSES_BY_CODE.get(tag)
+                    if block_class is None:
+                        break
+                    block_class.skip(p)
+                start = f.tell()
+        except EOFError:
+            pass
+
+    @staticmethod
+    def count_mapped_heap_dump(p, counts, sizes, visit=None, watched=(), watch_instance=None, watch_array=None,
+                               class_dump=None, record=None):
+        """count_heap_dump unpacking headers straight from the mapping
+        """
+        f = p.f
+        buf = f.buf
+        position = f.pos
+        end = f.size if p.length is None else min(p.base + p.length, f.size)
+        id_size = p.id_size
+        value_sizes = p.value_sizes
+        instance_header = p.structs['>OIOI']
+        object_array_header = p.structs['>OIIO']
+        primitive_array_header = p.structs['>OIIB']
+        try:
+            while position < end:
+                start = position
+                tag = buf[position]
+                position += 1
+                if tag == INSTANCE_DUMP:
+                    id, _, class_id, n_bytes = instance_header.unpack_from(buf, position)
+                    if record is not None:
+                        record(tag, id, class_id, start)
+                    position += instance_header.size
+                    if class_id in watched:
+                        watch_instance(id, class_id, buf[position:position + n_bytes])
+                    position += n_bytes
+                    counts[class_id] += 1
+                    sizes[class_id] += n_bytes
+                    if visit is not None:
+                        visit(id, class_id, n_bytes)
+                elif tag == OBJECT_ARRAY_DUMP:
+                    id, _, n_elements, class_id = object_array_header.unpack_from(buf, position)
+                    if record is not None:
+                        record(tag, id, class_id, start)
+                    position += object_array_header.size
+                    if class_id in watched:
+                        watch_array(id, class_id, n_elements, position)
+                    position += n_elements * id_size
+                    size = ARRAY_OVERHEAD + n_elements * id_size
+                    counts[class_id] += 1
+                    sizes[class_id] += size
+                    if visit is not None:
+                        visit(id, class_id, size)
+                elif tag == PRIMITIVE_ARRAY_DUMP:
+                    id, _, n_elements, code = primitive_array_header.unpack_from(buf, position)
+                    position += primitive_array_header.size
+                    tp = OBJECT_TYPES[code]
+                    if record is not None:
+                        record(tag, id, tp, start)
+                    if tp in watched:
+                        watch_array(id, tp, n_elements, position)
+                    n_bytes = n_elements * value_sizes[code]
+                    position += n_bytes
+                    counts[tp] += 1
+                    sizes[tp] += ARRAY_OVERHEAD + n_bytes
+                    if visit is not None:
+                        visit(id, tp, ARRAY_OVERHEAD + n_bytes)
+                elif tag == CLASS_DUMP and class_dump is not None:
+                    f.pos = position
+                    try:
+                        c = ClassDump.parse(p)
+                    except EOFError:
+                        break
+                    position = f.pos
+                    class_dump(c, start)
+                else:
+                    block_class = HEAP_BLOCK_CLASSES_BY_CODE.get(tag)
+                    if block_class is None:
+                        break
+                    f.pos = position
+                    try:
+                        block_class.skip(p)
+                    except EOFError:
+                        break
+                    position = f.pos
+        except (IndexError, struct.error):
+            # Truncated dump
+            pass
+        f.pos = min(position, f.size)
+
+    def by_name(self):
+        """The histogram keyed by class name, summing the classes of different class loaders
+        """
+        counts = Counter()
+        sizes = Counter()
+        for key in self.counts:
+            name = self.names.get(key) or str(key)
+            counts[name] += self.counts[key]
+            sizes[name] += self.sizes[key]
+        return ClassHistogram(counts, sizes, dict((name, name) for name in counts))
+
+    def rows(self):
+        """(class name, count, shallow bytes) for every class, largest first
+        """
+        return sorted(((self.names.get(key) or str(key), self.counts[key], self.sizes[key]) for key in self.counts),
+                      key=lambda row: (-row[2], row[0]))
+
+    def __str__(self):
+        lines = ['%12s %14s  %s' % ('instances', 'bytes', 'class')]
+        lines.extend('%12d %14d  %s' % (count, size, name) for name, count, size in self.rows())
+        return '\n'.join(lines)
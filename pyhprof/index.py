@@ -0,0 +1,295 @@
+"""Persistent sidecar index for random access into a Java hprof file.
+
+One indexing pass records the offsets of the top-level records, the offset of every
+heap sub-record by object id, the instance records of every class, the string table and
+the class table. The index is
+written next to the dump and fingerprinted by the hprof header, size and mtime, so
+later opens memory map it instead of re-scanning the dump.
+"""
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+from .constants import TAGS
+from .blocks import BLOCK_CLASSES_BY_TAG, GenericBlock
+from .histogram import ClassHistogram, INSTANCE_DUMP
+from .parsers import HeapDumpParser, ID_CODES
+from .store import sort_ids
+
+INDEX_SUFFIX = '.pyhprof-index'
+
+MAGIC = b'PYHPROF-INDEX\x01'
+HEADER = struct.Struct('<QQ')
+SECTION = struct.Struct('<8scxxxxxxxQ')
+
+
+def file_fingerprint(parser):
+    """Identify the dump behind a parser by its header, size and modification time
+    """
+    st = os.fstat(parser.f.fileno())
+    header = parser.format + struct.pack('>IQ', parser.id_size, parser.start_time)
+    return header + HEADER.pack(st.st_size, st.st_mtime_ns) + sys.byteorder.encode()
+
+
+def sidecar_path(parser):
+    return parser.f.name + INDEX_SUFFIX
+
+
+def write_sections(path, fingerprint, sections):
+    """Write named arrays to `path` behind a fingerprint, 8-byte aligned so they can be
+    memory mapped and cast in place by read_sections
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(fingerprint)))
+        f.write(fingerprint)
+        f.write(struct.pack('<I', len(sections)))
+        for name, a in sections:
+            f.write(b'\0' * (-f.tell() % 8))
+            f.write(SECTION.pack(name.encode(), a.typecode.encode(), len(a)))
+            a.tofile(f)
+    os.rename(tmp, path)
+
+
+def read_sections(path, fingerprint):
+    """Memory map a file written by write_sections, returning a dict of typed memoryviews,
+    or None if it is missing or was written for a different fingerprint
+    """
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size < len(MAGIC) + 4:
+            return None
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(m)
+    offset = len(MAGIC)
+    if buf[:offset] != MAGIC:
+        return None
+    n, = struct.unpack_from('<I', buf, offset)
+    offset += 4
+    if buf[offset:offset + n] != fingerprint:
+        return None
+    offset += n
+    n_sections, = struct.unpack_from('<I', buf, offset)
+    offset += 4
+    sections = {}
+    for _ in range(n_sections):
+        offset += -offset % 8
+        name, typecode, count = SECTION.unpack_from(buf, offset)
+        offset += SECTION.size
+        typecode = typecode.decode()
+        size = array(typecode).itemsize * count
+        sections[name.rstrip(b'\0').decode()] = buf[offset:offset + size].cast(typecode)
+        offset += size
+    return sections
+
+
+def pack_strings(strings, id_code='Q'):
+    ids = array(id_code)
+    offsets = array('Q', [0])
+    blob = bytearray()
+    for id, s in strings.items():
+        ids.append(id)
+        blob += s.encode('utf-8', 'surrogateescape')
+        offsets.append(len(blob))
+    return ids, offsets, array('B', bytes(blob))
+
+
+def unpack_strings(ids, offsets, blob):
+    blob = blob.tobytes()
+    return dict((ids[i], blob[offsets[i]:offsets[i + 1]].decode('utf-8', 'surrogateescape'))
+                for i in range(len(ids)))
+
+
+class HProfIndex(object):
+    """Offsets of the records of an hprof file plus its string and class tables.
+
+    `object_ids` is sorted and `object_offsets` holds the file offset of the matching
+    CLASS_DUMP, INSTANCE_DUMP, OBJECT_ARRAY_DUMP or PRIMITIVE_ARRAY_DUMP sub-record.
+    The INSTANCE_DUMP offsets of the instances of the class `instance_class_ids[i]` (sorted)
+    are `instance_offsets[instance_starts[i]:instance_starts[i + 1]]`, in file order. Ids
+    are stored with the array typecode `id_code`, 'I' for dumps with 4 byte ids.
+    """
+
+    def __init__(self, fingerprint, record_tags, record_times, record_starts, record_lengths,
+                 object_ids, object_offsets, strings, class_name_ids, class_offsets,
+                 instance_class_ids=(), instance_starts=(0,), instance_offsets=(), id_code='Q'):
+        self.fingerprint = fingerprint
+        self.id_code = id_code
+        self.record_tags = record_tags
+        self.record_times = record_times
+        self.record_starts = record_starts
+        self.record_lengths = record_lengths
+        self.object_ids = object_ids
+        self.object_offsets = object_offsets
+        self.strings = strings
+        self.class_name_ids = class_name_ids
+        self.class_offsets = class_offsets
+        self.instance_class_ids = instance_class_ids
+        self.instance_starts = instance_starts
+        self.instance_offsets = instance_offsets
+
+    @classmethod
+    def open(cls, parser, path=None):
+        """Load the index of the dump read by `parser`, building and writing it first if
+        there is no up to date index at `path` (by default next to the dump)
+        """
+        if path is None:
+            path = sidecar_path(parser)
+        fingerprint = file_fingerprint(parser)
+        index = cls.read(path, fingerprint)
+        if index is None:
+            index = cls.build(parser, fingerprint)
+            try:
+                index.write(path)
+            except (IOError, OSError):
+                pass
+        return index
+
+    @classmethod
+    def build(cls, parser, fingerprint=None):
+        if fingerprint is None:
+            fingerprint = file_fingerprint(parser)
+        tags = array('B')
+        times = array('I')
+        starts = array('Q')
+        lengths = array('I')
+        strings = {}
+        class_name_ids = {}
+        heap_dumps = []
+        with parser.goto(parser.first_record):
+            for b in parser:
+                tags.append(b.tag)
+                times.append(b.record_time)
+                starts.append(b.start)
+                lengths.append(b.length)
+                if b.tag_name == 'HEAP_DUMP' or b.tag_name == 'HEAP_DUMP_SEGMENT':
+                    heap_dumps.append(b)
+                elif b.tag_name == 'STRING':
+                    strings[b.id] = b.contents
+                elif b.tag_name == 'LOAD_CLASS':
+                    class_name_ids[b.class_id] = b.class_name_id
+
+        id_code = ID_CODES[parser.id_size]
+        ids = array(id_code)
+        offsets = array('Q')
+        class_offsets = {}
+        instances = {}
+
+        def record(tag, id, key, start):
+            ids.append(id)
+            offsets.append(start)
+            if tag == INSTANCE_DUMP:
+                try:
+                    instances[key].append(start)
+                except KeyError:
+                    instances[key] = array('Q', [start])
+
+        def class_dump(c, start):
+            class_offsets[c.id] = start
+            ids.append(c.id)
+            offsets.append(start)
+
+        # Only the headers of the sub-records are read, and class dumps
+        for block in heap_dumps:
+            with parser.goto(block.start):
+                ClassHistogram.count_heap_dump(HeapDumpParser(parser.f, parser.id_size, block.length),
+                                               Counter(), Counter(), class_dump=class_dump, record=record)
+        if any(ids[i] > ids[i + 1] for i in range(len(ids) - 1)):
+            ids, order = sort_ids(ids, id_code)
+            offsets = array('Q', map(offsets.__getitem__, order))
+        instance_class_ids = array(id_code, sorted(instances))
+        instance_starts = array('Q', [0])
+        instance_offsets = array('Q')
+        for class_id in instance_class_ids:
+            instance_offsets.extend(instances[class_id])
+            instance_starts.append(len(instance_offsets))
+        return cls(fingerprint, tags, times, starts, lengths, ids, offsets,
+                   strings, class_name_ids, class_offsets,
+                   instance_class_ids, instance_starts, instance_offsets, id_code)
+
+    def write(self, path):
+        id_code = self.id_code
+        string_ids, string_offsets, string_blob = pack_strings(self.strings, id_code)
+        write_sections(path, self.fingerprint, [
+            ('tags', array('B', self.record_tags)),
+            ('times', array('I', self.record_times)),
+            ('starts', array('Q', self.record_starts)),
+            ('lengths', array('I', self.record_lengths)),
+            ('ids', array(id_code, self.object_ids)),
+            ('offsets', array('Q', self.object_offsets)),
+            ('str_ids', string_ids),
+            ('str_offs', string_offsets),
+            ('str_blob', string_blob),
+            ('cls_ids', array(id_code, self.class_name_ids.keys())),
+            ('cls_name', array(id_code, self.class_name_ids.values())),
+            ('dump_ids', array(id_code, self.class_offsets.keys())),
+            ('dump_off', array('Q', self.class_offsets.values())),
+            ('ins_cls', array(id_code, self.instance_class_ids)),
+            ('ins_strt', array('Q', self.instance_starts)),
+            ('ins_off', array('Q', self.instance_offsets)),
+        ])
+
+    @classmethod
+    def read(cls, path, fingerprint):
+        s = read_sections(path, fingerprint)
+        if s is None or 'ins_off' not in s:
+            # Missing, or written before instances were indexed by class
+            return None
+        return cls(fingerprint, s['tags'], s['times'], s['starts'], s['lengths'], s['ids'], s['offsets'],
+                   unpack_strings(s['str_ids'], s['str_offs'], s['str_blob']),
+                   dict(zip(s['cls_ids'], s['cls_name'])),
+                   dict(zip(s['dump_ids'], s['dump_off'])),
+                   s['ins_cls'], s['ins_strt'], s['ins_off'], s['ids'].format)
+
+    def blocks(self, parser, tag_names=None):
+        """Top-level blocks of the dump, optionally only those with the given tag names
+        """
+        for i in range(len(self.record_tags)):
+            tag_name = TAGS.get(self.record_tags[i], 'UNKOWN')
+            if tag_names is None or tag_name in tag_names:
+                yield BLOCK_CLASSES_BY_TAG.get(tag_name, GenericBlock)(
+                    self.record_tags[i], parser, self.record_times[i], self.record_starts[i],
+                    self.record_lengths[i])
+
+    def heap_dumps(self, parser):
+        return list(self.blocks(parser, ('HEAP_DUMP', 'HEAP_DUMP_SEGMENT')))
+
+    def object_offset(self, id):
+        """File offset of the sub-record of an object or class, or None if it is not indexed
+        """
+        i = bisect_left(self.object_ids, id)
+        if i < len(self.object_ids) and self.object_ids[i] == id:
+            return self.object_offsets[i]
+        return None
+
+    def instances_of(self, class_id):
+        """File offsets of the INSTANCE_DUMP records of the direct instances of a class
+        """
+        i = bisect_left(self.instance_class_ids, class_id)
+        if i < len(self.instance_class_ids) and self.instance_class_ids[i] == class_id:
+            return self.instance_offsets[self.instance_starts[i]:self.instance_starts[i + 1]]
+        return self.instance_offsets[0:0]
+
+    def read_object(self, parser, id):
+        """Parse the heap sub-record of an object or class id straight from its offset
+        """
+        offset = self.object_offset(id)
+        if offset is None:
+            raise KeyError(id)
+        with parser.goto(offset):
+            return HeapDumpParser(parser.f, parser.id_size).read_next_block()
+
+    def __len__(self):
+        return len(self.object_ids)
+
+    def __contains__(self, id):
+        return self.object_offset(id) is not None
@@ -0,0 +1,125 @@
+"""Progress reporting and statistics for long running parses.
+"""
+
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from .heap_blocks import HEAP_BLOCK_CLASSES_BY_TAG
+
+SUB_TAGS_BY_CLASS = dict((cls, tag) for tag, cls in HEAP_BLOCK_CLASSES_BY_TAG.items())
+
+
+class Instrumentation(object):
+    """Counts of the records read by instrumented parsers (see BaseParser.instrument) and
+    timings of the phases of a parse.
+
+    While a phase runs, `bytes_done` tracks how far it got out of `total_bytes` and
+    `callback(instrumentation)` is called each time another `interval` bytes are done.
+    """
+
+    def __init__(self, callback=None, interval=64 * 2 ** 20):
+        self.callback = callback
+        self.interval = interval
+        self.start_time = time.time()
+        self.record_counts = Counter()
+        self.record_bytes = Counter()
+        self.sub_record_counts = Counter()
+        self.sub_record_bytes = Counter()
+        self.phases = {}
+        self.phase_name = None
+        self.phase_start = None
+        self.total_bytes = None
+        self.bytes_done = 0
+        self.next_report = interval
+
+    def __getstate__(self):
+        state = dict(vars(self))
+        state['callback'] = None
+        return state
+
+    @contextmanager
+    def phase(self, name, total_bytes=None):
+        self.phase_name = name
+        self.phase_start = time.time()
+        self.total_bytes = total_bytes
+        self.bytes_done = 0
+        self.next_report = self.interval
+        try:
+            yield self
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - self.phase_start
+            if self.total_bytes is not None:
+                self.bytes_done = self.total_bytes
+            self.report()
+
+    def record(self, tag_name, n_bytes, position):
+        """Count a top-level record, whose contents start at file offset `position`
+        """
+        self.record_counts[tag_name] += 1
+        self.record_bytes[tag_name] += n_bytes
+        self.bytes_done = position
+        if position >= self.next_report:
+            self.report()
+
+    def sub_record(self, tag_name, n_bytes):
+        self.sub_record_counts[tag_name] += 1
+        self.sub_record_bytes[tag_name] += n_bytes
+        self.bytes_done += n_bytes
+        if self.bytes_done >= self.next_report:
+            self.report()
+
+    def advance(self, n_bytes):
+        self.bytes_done += n_bytes
+        if self.bytes_done >= self.next_report:
+            self.report()
+
+    def merge(self, other):
+        """Add the record counts of another instrumentation, as returned by a segment worker
+        """
+        self.record_counts.update(other.record_counts)
+        self.record_bytes.update(other.record_bytes)
+        self.sub_record_counts.update(other.sub_record_counts)
+        self.sub_record_bytes.update(other.sub_record_bytes)
+
+    def report(self):
+        self.next_report = self.bytes_done + self.interval
+        if self.callback is not None:
+            self.callback(self)
+
+    @property
+    def rate(self):
+        """Bytes per second in the current phase
+        """
+        if self.phase_start is None:
+            return None
+        elapsed = time.time() - self.phase_start
+        return self.bytes_done / elapsed if elapsed > 0 else None
+
+    @property
+    def eta(self):
+        """Estimated seconds left in the current phase, or None if unknown
+        """
+        rate = self.rate
+        if not rate or self.total_bytes is None:
+            return None
+        return max(self.total_bytes - self.bytes_done, 0) / rate
+
+    def summary(self):
+        return {
+            'elapsed': time.time() - self.start_time,
+            'phases': dict(self.phases),
+            'phase': self.phase_name,
+            'bytes_done': self.bytes_done,
+            'total_bytes': self.total_bytes,
+            'bytes_per_second': self.rate,
+            'eta': self.eta,
+            'records': dict((tag, {'count': self.record_counts[tag], 'bytes': self.record_bytes[tag]})
+                            for tag in self.record_counts),
+            'sub_records': dict((tag, {'count': self.sub_record_counts[tag], 'bytes': self.sub_record_bytes[tag]})
+                                for tag in self.sub_record_counts)
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.summary(), **kwargs)
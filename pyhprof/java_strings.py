@@ -0,0 +1,271 @@
+"""Bulk decoding of the java.lang.String instances of a heap dump, without building any
+references.
+"""
+
+from array import array
+from collections import Counter
+
+from .compressed import CompressedFile, is_compressed
+from .constants import OBJECT_TYPE_CODES
+from .histogram import ClassHistogram
+from .parsers import HProfParser, HeapDumpParser, HEAP_BLOCK_CLASSES_BY_CODE, ID_CODES, U1
+from .references import InstanceLayout
+from .store import KIND_CODES
+
+PRIMITIVE_ARRAY_DUMP = KIND_CODES['PRIMITIVE_ARRAY_DUMP']
+BYTE = OBJECT_TYPE_CODES['BYTE']
+CHAR = OBJECT_TYPE_CODES['CHAR']
+
+STRING_CLASS_NAMES = ('java/lang/String', 'java.lang.String')
+
+# Values of String.coder (Java 9+)
+LATIN1 = 0
+UTF16 = 1
+
+
+def decode_string(data, code, coder=LATIN1, start=0, count=-1, utf16='utf-16-le'):
+    """Text of a String from the contents of its value array, with the element type code
+    of the array, the String's coder and, for old JVMs whose Strings share arrays, the
+    String's offset and count (-1 for the whole array)
+    """
+    if code == CHAR:
+        # char[] elements are dumped big-endian
+        encoding, unit = 'utf-16-be', 2
+    elif coder == UTF16:
+        # UTF16 byte[] contents are in the byte order of the JVM's platform
+        encoding, unit = utf16, 2
+    else:
+        encoding, unit = 'latin-1', 1
+    if count >= 0:
+        data = data[start * unit:(start + count) * unit]
+    return str(data, encoding, 'replace')
+
+
+class JavaStrings(object):
+    """The text of every java.lang.String in a dump, as (string object id, text) pairs.
+
+    A first pass over the dump reads only the String instances, the class dumps and the
+    headers of byte and char arrays, recording the file offset of each array by id. The
+    value arrays of the Strings are then read in order of their offsets, `batch_bytes`
+    at most at a time, and decoded by element type and coder. Compressed dumps are read
+    sequentially, decoding the value arrays in a second pass over the dump instead.
+
+    `utf16` is the codec of UTF16 coded byte[] values, which hold the JVM's native byte
+    order. Strings whose value array is null or not in the dump are left out.
+    """
+
+    def __init__(self, f, use_mmap=False, compressed=None, batch_bytes=2 ** 20, utf16='utf-16-le'):
+        if compressed is None:
+            compressed = is_compressed(f)
+        self.p = HProfParser(CompressedFile(f) if compressed else f, use_mmap)
+        self.batch_bytes = batch_bytes
+        self.utf16 = utf16
+        self.strings = {}
+        self.class_name_ids = {}
+        self.string_class_ids = None
+        # (super class id, instance fields) of each dumped class, and the String layouts
+        self.class_fields = {}
+        self.layouts = {}
+        id_code = ID_CODES[self.p.id_size]
+        # One row per String instance, coder -1 if it has none and count -1 if the String
+        # has no offset and count fields
+        self.string_ids = array(id_code)
+        self.value_ids = array(id_code)
+        self.coders = array('b')
+        self.starts = array('i')
+        self.counts = array('i')
+        # String instances seen before their class dump, as (id, class id, data)
+        self.pending = []
+        # Byte and char arrays, unless the dump is read sequentially
+        self.array_ids = None if self.p.sequential else array(id_code)
+        self.array_offsets = array('Q')
+        self.array_lengths = array('I')
+        self.array_codes = array('B')
+        self._table = None
+        self.scanned = False
+
+    def scan(self):
+        """First pass, over the dump's records and the String instances
+        """
+        p = self.p
+        heap_dumps = []
+        for b in p:
+            if b.tag_name == 'HEAP_DUMP' or b.tag_name == 'HEAP_DUMP_SEGMENT':
+                if p.sequential:
+                    self.scan_heap_dump(b)
+                else:
+                    heap_dumps.append(b)
+            elif b.tag_name == 'STRING':
+                self.strings[b.id] = b.contents
+            elif b.tag_name == 'LOAD_CLASS':
+                self.class_name_ids[b.class_id] = b.class_name_id
+        for b in heap_dumps:
+            self.scan_heap_dump(b)
+        for id, class_id, data in self.pending:
+            try:
+                self.add_string(id, class_id, data)
+            except KeyError:
+                # The String class or one of its field names is not in the dump
+                pass
+        self.pending = []
+        self.scanned = True
+
+    def heap_dump_parser(self, block):
+        self.p.f.seek(block.start)
+        return HeapDumpParser(self.p.f, self.p.id_size, block.length)
+
+    def scan_heap_dump(self, block):
+        if self.string_class_ids is None:
+            self.string_class_ids = set(class_id for class_id, name_id in self.class_name_ids.items()
+                                        if self.strings.get(name_id) in STRING_CLASS_NAMES)
+        watched = set(self.string_class_ids)
+        if self.array_ids is not None:
+            watched.update(('BYTE', 'CHAR'))
+        ClassHistogram.count_heap_dump(self.heap_dump_parser(block), Counter(), Counter(), watched=watched,
+                                       watch_instance=self.watch_string, watch_array=self.watch_array,
+                                       class_dump=self.add_class_dump)
+
+    def watch_string(self, id, class_id, data):
+        try:
+            self.add_string(id, class_id, data)
+        except KeyError:
+            self.pending.append((id, class_id, bytes(data)))
+
+    def watch_array(self, id, tp, n_elements, offset):
+        self.array_ids.append(id)
+        self.array_offsets.append(offset)
+        self.array_lengths.append(n_elements)
+        self.array_codes.append(OBJECT_TYPE_CODES[tp])
+
+    def add_class_dump(self, c, start):
+        self.class_fields[c.id] = (c.super_class_id, c.instance_fields)
+
+    def layout(self, class_id):
+        """(InstanceLayout, index of value, coder, offset and count or None) of a String class
+        """
+        try:
+            return self.layouts[class_id]
+        except KeyError:
+            pass
+        fields = []
+        c = class_id
+        while c:
+            c, instance_fields = self.class_fields[c]
+            fields.extend(instance_fields)
+        layout = InstanceLayout(self.p.structs, self.strings, fields)
+        names = [self.strings.get(name_id) for name_id, tp in fields]
+        indexes = tuple(names.index(name) if name in names else None
+                        for name in ('value', 'coder', 'offset', 'count'))
+        self.layouts[class_id] = layout, indexes
+        return layout, indexes
+
+    def add_string(self, id, class_id, data):
+        """Record a String instance. Raises KeyError if its class is not dumped yet
+        """
+        layout, (value, coder, start, count) = self.layout(class_id)
+        if value is None or layout.struct.size != len(data):
+            return
+        values = layout.struct.unpack(data)
+        if not values[value]:
+            return
+        self.string_ids.append(id)
+        self.value_ids.append(values[value])
+        self.coders.append(-1 if coder is None else values[coder])
+        if start is None or count is None:
+            self.starts.append(0)
+            self.counts.append(-1)
+        else:
+            self.starts.append(values[start])
+            self.counts.append(values[count])
+
+    def rows_by_value(self):
+        """Rows of the Strings by the id of their value array
+        """
+        rows = {}
+        shared = {}
+        for i, value_id in enumerate(self.value_ids):
+            if value_id in rows:
+                shared.setdefault(value_id, [rows[value_id]]).append(i)
+            else:
+                rows[value_id] = i
+        return rows, shared
+
+    def decode(self, i, data, code):
+        return decode_string(data, code, self.coders[i], self.starts[i], self.counts[i], self.utf16)
+
+    def __iter__(self):
+        if not self.scanned:
+            self.scan()
+        if self.p.sequential:
+            return self.decode_sequential()
+        return self.decode_located()
+
+    def decode_located(self):
+        p = self.p
+        rows, shared = self.rows_by_value()
+        value_sizes = p.value_sizes
+        located = []
+        array_ids = self.array_ids
+        for j in range(len(array_ids)):
+            i = rows.get(array_ids[j])
+            if i is not None:
+                located.append((self.array_offsets[j], self.array_lengths[j] * value_sizes[self.array_codes[j]],
+                                self.array_codes[j], i))
+        located.sort()
+        n = 0
+        while n < len(located):
+            # Read a run of nearby arrays at once
+            start = located[n][0]
+            m = n + 1
+            while m < len(located) and located[m][0] + located[m][1] - start <= self.batch_bytes:
+                m += 1
+            end = max(offset + length for offset, length, code, i in located[n:m])
+            if p.mapped:
+                data = p.f.buf[start:end]
+            else:
+                with p.goto(start):
+                    data = memoryview(p.read(end - start))
+            for offset, length, code, i in located[n:m]:
+                value = data[offset - start:offset - start + length]
+                for row in shared.get(self.value_ids[i], (i,)):
+                    yield self.string_ids[row], self.decode(row, value, code)
+            n = m
+
+    def decode_sequential(self):
+        p = self.p
+        rows, shared = self.rows_by_value()
+        p.next_record = p.first_record
+        for b in p:
+            if b.tag_name != 'HEAP_DUMP' and b.tag_name != 'HEAP_DUMP_SEGMENT':
+                continue
+            hp = self.heap_dump_parser(b)
+            f = hp.f
+            end = hp.base + hp.length
+            value_sizes = hp.value_sizes
+            array_header = hp.structs['>OIIB']
+            try:
+                while f.tell() < end:
+                    tag = hp.unpack(U1)[0]
+                    if tag == PRIMITIVE_ARRAY_DUMP:
+                        id, _, n_elements, code = hp.unpack(array_header)
+                        i = rows.get(id)
+                        if i is None:
+                            hp.seek(n_elements * value_sizes[code])
+                            continue
+                        value = hp.read(n_elements * value_sizes[code])
+                        for row in shared.get(id, (i,)):
+                            yield self.string_ids[row], self.decode(row, value, code)
+                    else:
+                        block_class = HEAP_BLOCK_CLASSES_BY_CODE.get(tag)
+                        if block_class is None:
+                            break
+                        block_class.skip(hp)
+            except EOFError:
+                pass
+
+    def table(self):
+        """{string object id: text}, decoded once
+        """
+        if self._table is None:
+            self._table = dict(self)
+        return self._table
@@ -4,23 +4,128 @@ Specification in: https://java.net/downloads/heap-snapshot/hprof-binary-format.h
 
 from __future__ import division
 
+import mmap
 import os
 import struct
+import sys
+from array import array
+from collections import deque
 from contextlib import contextmanager
 
-from .constants import TAGS, HEAP_DUMP_SUB_TAGS, OBJECT_TYPES, TYPE_SIZES
+from .constants import TAGS, HEAP_DUMP_SUB_TAGS, OBJECT_TYPES, OBJECT_TYPE_CODES, TYPE_SIZES, TYPE_STRUCT_CODES
 from .blocks import BLOCK_CLASSES_BY_TAG, GenericBlock
 from .heap_blocks import HEAP_BLOCK_CLASSES_BY_TAG
+from .instrumentation import SUB_TAGS_BY_CLASS
 
-class BaseParser(object):
+class MappedFile(object):
+    """Read-only file-like view of a memory mapped file.
+
+    read() returns memoryview slices into the mapping rather than copies, and the
+    mapping is exposed as `buf` so parsers can unpack fields in place.
+    """
 
     def __init__(self, f):
+        self.file = f
+        self.name = getattr(f, 'name', None)
+        self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self.mmap)
+        self.size = len(self.buf)
+        self.pos = 0
+
+    def read(self, n=-1):
+        start = self.pos
+        end = self.size if n < 0 else min(start + n, self.size)
+        self.pos = end
+        return self.buf[start:end]
+
+    def seek(self, n, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            n += self.pos
+        elif whence == os.SEEK_END:
+            n += self.size
+        self.pos = n
+        return n
+
+    def tell(self):
+        return self.pos
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.buf.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            # Records still hold slices of the mapping, which is unmapped once they are collected
+            pass
+        self.file.close()
+
+
+U1 = struct.Struct('>B')
+U2 = struct.Struct('>H')
+U4 = struct.Struct('>I')
+U8 = struct.Struct('>Q')
+RECORD_HEADER = struct.Struct('>BII')
+F4 = struct.Struct('>f')
+F8 = struct.Struct('>d')
+
+ID_CODES = {4: 'I', 8: 'Q'}
+
+
+class RecordStructs(dict):
+    """Precompiled structs for big-endian record layouts keyed by format, where `O` stands
+    for an identifier of the dump's id size (e.g. '>OIOI' for an INSTANCE_DUMP header)
+    """
+
+    def __init__(self, id_size=None):
+        super(RecordStructs, self).__init__()
+        self.id_size = id_size
+
+    def __missing__(self, fmt):
+        if self.id_size is not None:
+            s = struct.Struct(fmt.replace('O', ID_CODES[self.id_size]))
+        else:
+            s = struct.Struct(fmt)
+        self[fmt] = s
+        return s
+
+
+RECORD_STRUCTS = dict((id_size, RecordStructs(id_size)) for id_size in ID_CODES)
+PLAIN_STRUCTS = RecordStructs()
+
+
+# Sub-record parsers keyed by the raw tag byte. HEAP_DUMP_END and unknown tags are absent
+HEAP_BLOCK_CLASSES_BY_CODE = dict((tag, HEAP_BLOCK_CLASSES_BY_TAG[name])
+                                  for tag, name in HEAP_DUMP_SUB_TAGS.items()
+                                  if name in HEAP_BLOCK_CLASSES_BY_TAG)
+
+
+class BaseParser(object):
+
+    id_size = None
+    structs = PLAIN_STRUCTS
+
+    def __init__(self, f, use_mmap=False):
+        if use_mmap and not isinstance(f, MappedFile):
+            position = f.tell()
+            f = MappedFile(f)
+            f.seek(position)
         self.f = f
+        if isinstance(f, MappedFile):
+            self.unpack = self.unpack_mapped
+
+    @property
+    def mapped(self):
+        return isinstance(self.f, MappedFile)
 
     def close(self):
         self.f.close()
         self.f = None
 
+    def tell(self):
+        return self.f.tell()
+
     def read(self, n):
         b = self.f.read(n)
         if len(b) != n:
@@ -30,29 +135,53 @@ class BaseParser(object):
     def seek(self, n):
         self.f.seek(n, os.SEEK_CUR)
 
+    def unpack(self, s):
+        return s.unpack(self.read(s.size))
+
+    def unpack_mapped(self, s):
+        mf = self.f
+        offset = mf.pos
+        end = offset + s.size
+        if end > mf.size:
+            raise EOFError()
+        mf.pos = end
+        return s.unpack_from(mf.buf, offset)
+
     def u1(self):
         return self.read(1)
 
     def i1(self):
-        return ord(self.u1())
+        return self.unpack(U1)[0]
 
     def read_struct(self, f, n=None):
-        if n is None:
-            n = struct.calcsize(f)
-        return struct.unpack(f, self.read(n))[0]
+        return self.unpack(self.structs[f])[0]
 
     def i2(self):
-        return self.read_struct('>H', 2)
+        return self.unpack(U2)[0]
 
     def i4(self):
-        return self.read_struct('>I', 4)
+        return self.unpack(U4)[0]
 
     def i8(self):
-        return self.read_struct('>Q', 8)
+        return self.unpack(U8)[0]
 
     def set_id_size(self, id_size):
         self.id_size = id_size
+        self.id_code = ID_CODES[id_size]
+        self.structs = RECORD_STRUCTS[id_size]
         self.read_id = self.i4 if self.id_size == 4 else self.i8
+        self.value_structs = dict((code, self.structs['>' + TYPE_STRUCT_CODES[tp]])
+                                  for code, tp in OBJECT_TYPES.items())
+        self.value_sizes = dict((code, s.size) for code, s in self.value_structs.items())
+
+    def read_id_array(self, n):
+        """Read `n` ids into a typed array
+        """
+        ids = array(self.id_code)
+        ids.frombytes(self.read(n * self.id_size))
+        if sys.byteorder == 'little':
+            ids.byteswap()
+        return ids
 
     def read_value_type(self):
         return OBJECT_TYPES[self.i1()]
@@ -64,33 +193,23 @@ class BaseParser(object):
         return self.i2()
 
     def read_float(self):
-        return self.read_struct('f', 4)
+        return self.unpack(F4)[0]
 
     def read_double(self):
-        return self.read_struct('d', 8)
+        return self.unpack(F8)[0]
 
     def read_value(self, tp):
-        if tp == 'OBJECT':
-            return self.read_id()
-        elif tp == 'BOOLEAN':
-            return self.read_bool()
-        elif tp == 'CHAR':
-            return self.read_char()
-        elif tp == 'FLOAT':
-            return self.read_float()
-        elif tp == 'DOUBLE':
-            return self.read_double()
-        elif tp == 'BYTE':
-            return self.i1()
-        elif tp == 'SHORT':
-            return self.i2()
-        elif tp == 'INT':
-            return self.i4()
-        elif tp == 'LONG':
-            return self.i8()
-        else:
+        try:
+            return self.unpack(self.value_structs[OBJECT_TYPE_CODES[tp]])[0]
+        except KeyError:
             raise ValueError("Unkown tp %r" % (tp,))
 
+    def read_typed_value(self):
+        """Read a type byte followed by a value of that type, returning (type name, value)
+        """
+        code = self.i1()
+        return OBJECT_TYPES[code], self.unpack(self.value_structs[code])[0]
+
     def type_size(self, tp):
         if tp == 'OBJECT':
             return self.id_size
@@ -110,8 +229,13 @@ class BaseParser(object):
 
 class HProfParser(BaseParser):
 
-    def __init__(self, f):
-        super(HProfParser, self).__init__(f)
+    def __init__(self, f, use_mmap=False):
+        super(HProfParser, self).__init__(f, use_mmap)
+        # Files that can only be read efficiently front to back, see compressed.CompressedFile
+        self.sequential = getattr(self.f, 'sequential', False)
+        self.next_record = None
+        if self.sequential:
+            self.read_next_block = self.read_next_block_sequential
         self.read_header()
 
     def read_header(self):
@@ -124,17 +248,44 @@ class HProfParser(BaseParser):
         self.format = f
         self.set_id_size(self.i4())
         self.start_time = self.i8()
+        self.first_record = self.f.tell()
 
     def read_next_block(self):
-        tag = ord(self.u1())
+        tag, record_time, length = self.unpack(RECORD_HEADER)
         tag_name = TAGS.get(tag, 'UNKOWN')
-        record_time = self.i4()
-        length = self.i4()
         start = self.f.tell()
         self.seek(length)
         block = BLOCK_CLASSES_BY_TAG.get(tag_name, GenericBlock)(tag, self, record_time, start, length)
         return block
 
+    def read_next_block_sequential(self):
+        """read_next_block for sequential files. Records are only skipped when the next one
+        is read, so a heap dump can be parsed in place before moving on, and the contents
+        of STRING and LOAD_CLASS records are read straight away
+        """
+        if self.next_record is not None:
+            self.f.seek(self.next_record)
+        tag, record_time, length = self.unpack(RECORD_HEADER)
+        start = self.f.tell()
+        self.next_record = start + length
+        block = BLOCK_CLASSES_BY_TAG.get(TAGS.get(tag, 'UNKOWN'), GenericBlock)(tag, self, record_time, start, length)
+        if hasattr(block, 'parse_contents'):
+            block.parse_contents()
+        return block
+
+    def instrument(self, instrumentation):
+        """Count every record read from now on in an Instrumentation. Only instrumented
+        parsers pay for it
+        """
+        read_next_block = self.read_next_block
+
+        def instrumented_read_next_block():
+            block = read_next_block()
+            if block is not None:
+                instrumentation.record(block.tag_name, RECORD_HEADER.size + block.length, block.start)
+            return block
+        self.read_next_block = instrumented_read_next_block
+
     @contextmanager
     def goto(self, goto=None):
         start = self.f.tell()
@@ -146,32 +297,147 @@ class HProfParser(BaseParser):
 
 class HeapDumpParser(BaseParser):
 
-    def __init__(self, f, id_size, length=None):
-        super(HeapDumpParser, self).__init__(f)
+    def __init__(self, f, id_size, length=None, use_mmap=False, lazy_payloads=False, wanted=None):
+        super(HeapDumpParser, self).__init__(f, use_mmap)
         self.set_id_size(id_size)
         self.length = length
-        self.position = 0
+        self.lazy_payloads = lazy_payloads
+        self.base = self.f.tell()
+        self.wanted = None
+        if wanted is not None:
+            self.want(wanted)
+
+    @property
+    def position(self):
+        return self.f.tell() - self.base
 
     def check_position_in_bound(self):
         assert self.length is None or self.position <= self.length
 
-    def read(self, n):
-        content = super(HeapDumpParser, self).read(n)
-        self.position += n
-        self.check_position_in_bound()
-        return content
-
-    def seek(self, n):
-        super(HeapDumpParser, self).seek(n)
-        self.position += n
-        self.check_position_in_bound()
-
     def read_next_block(self):
-        if self.position == self.length:
+        position = self.position
+        assert self.length is None or position <= self.length
+        if position == self.length:
+            return
+        self.record_start = self.base + position
+        block_class = HEAP_BLOCK_CLASSES_BY_CODE.get(self.unpack(U1)[0])
+        if block_class is None:
+            return
+        return block_class.parse(self)
+
+    def want(self, tag_names):
+        """Only build the sub-records with these tag names from now on. The others are
+        skipped over using their lengths alone, and read_next_block returns their class in
+        their place so that callers still see the order of the records
+        """
+        self.wanted = frozenset(HEAP_BLOCK_CLASSES_BY_TAG[name] for name in tag_names)
+        self.read_next_block = self.read_next_wanted_block
+
+    def read_next_wanted_block(self):
+        position = self.position
+        assert self.length is None or position <= self.length
+        if position == self.length:
+            return
+        self.record_start = self.base + position
+        block_class = HEAP_BLOCK_CLASSES_BY_CODE.get(self.unpack(U1)[0])
+        if block_class is None:
             return
-        tag = self.u1()
-        if ord(tag) not in HEAP_DUMP_SUB_TAGS.keys():
+        if block_class in self.wanted:
+            return block_class.parse(self)
+        block_class.skip(self)
+        return block_class
+
+    def handle(self, handlers, default=None):
+        """Read the rest of the heap dump, passing each sub-record whose tag name has a
+        handler in `handlers` to it. The others are skipped without being built, and their
+        class passed to `default` if given. Returns the number of sub-records read
+        """
+        handlers_by_code = dict((code, handlers.get(HEAP_DUMP_SUB_TAGS[code]))
+                                for code in HEAP_BLOCK_CLASSES_BY_CODE)
+        f = self.f
+        end = float('inf') if self.length is None else self.base + self.length
+        count = 0
+        try:
+            while f.tell() < end:
+                self.record_start = f.tell()
+                code = self.unpack(U1)[0]
+                block_class = HEAP_BLOCK_CLASSES_BY_CODE.get(code)
+                if block_class is None:
+                    break
+                handler = handlers_by_code[code]
+                if handler is None:
+                    block_class.skip(self)
+                    if default is not None:
+                        default(block_class)
+                else:
+                    handler(block_class.parse(self))
+                count += 1
+        except EOFError:
+            pass
+        return count
+
+    def instrument(self, instrumentation):
+        """Count every sub-record read from now on in an Instrumentation
+        """
+        read_next_block = self.read_next_block
+        f = self.f
+
+        def instrumented_read_next_block():
+            start = f.tell()
+            block = read_next_block()
+            if block is not None:
+                block_class = block if isinstance(block, type) else type(block)
+                instrumentation.sub_record(SUB_TAGS_BY_CLASS[block_class], f.tell() - start)
+            return block
+        self.read_next_block = instrumented_read_next_block
+
+    def skip_next_block(self):
+        """Move past the next sub-record using only its header and lengths, returning its
+        class, or None at the end of the heap dump
+        """
+        position = self.position
+        assert self.length is None or position <= self.length
+        if position == self.length:
             return
-        if HEAP_DUMP_SUB_TAGS[ord(tag)] == 'HEAP_DUMP_END':
+        self.record_start = self.base + position
+        block_class = HEAP_BLOCK_CLASSES_BY_CODE.get(self.unpack(U1)[0])
+        if block_class is None:
             return
-        return HEAP_BLOCK_CLASSES_BY_TAG[HEAP_DUMP_SUB_TAGS[ord(tag)]].parse(self)
+        block_class.skip(self)
+        return block_class
+
+    def split(self, chunk_size, lookbehind=3):
+        """Pre-scan the rest of the heap dump, without building records, into chunks of
+        about `chunk_size` bytes that start on record boundaries.
+
+        Returns a list of (start, length, first_index, lookbehind_start) where `first_index`
+        is the number of records before the chunk and `lookbehind_start` is the offset of
+        the (up to) `lookbehind` records just before it, so that a chunk can be parsed on
+        its own with the context of its preceding records.
+        """
+        chunks = []
+        f = self.f
+        end = float('inf') if self.length is None else self.base + self.length
+        position = chunk_start = lookbehind_start = f.tell()
+        chunk_index = index = 0
+        starts = deque(maxlen=lookbehind)
+        try:
+            while position < end:
+                block_class = HEAP_BLOCK_CLASSES_BY_CODE.get(self.unpack(U1)[0])
+                if block_class is None:
+                    break
+                block_class.skip(self)
+                starts.append(position)
+                index += 1
+                position = f.tell()
+                if position - chunk_start >= chunk_size:
+                    chunks.append((chunk_start, position - chunk_start, chunk_index, lookbehind_start))
+                    chunk_start = position
+                    chunk_index = index
+                    lookbehind_start = starts[0]
+        except EOFError:
+            pass
+        end = f.tell() if self.length is None else self.base + self.length
+        if chunk_start < end:
+            chunks.append((chunk_start, end - chunk_start, chunk_index, lookbehind_start))
+        return chunks
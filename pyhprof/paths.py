@@ -0,0 +1,194 @@
+"""Shortest reference chains from the GC roots to an object, to explain why it is kept
+alive.
+"""
+
+import heapq
+from array import array
+from collections import deque
+
+from .constants import HEAP_DUMP_SUB_TAGS
+
+REFERENCE_CLASS_NAME = 'java/lang/ref/Reference'
+
+
+def referent_slots(classes, field_names):
+    """{class id: slot of the `referent` field} of java.lang.ref.Reference and its
+    subclasses, whose referents are only weakly (or softly, or phantom) reachable
+    """
+    slots = {}
+    for class_id, c in classes.items():
+        k = c
+        while k is not None and (k.name or '').replace('.', '/') != REFERENCE_CLASS_NAME:
+            k = classes.get(k.parent_class_id)
+        if k is None:
+            continue
+        names = field_names(class_id)
+        if names is not None and 'referent' in names:
+            slots[class_id] = names.index('referent')
+    return slots
+
+
+class GCRootPaths(object):
+    """Distances of every object from the GC roots of an ObjectGraph, from one multi-source
+    BFS, and the shortest chains of references from a root to any object.
+
+    `weak_slots` ({class id: edge slot}, see referent_slots) gives references that are
+    not followed, so that objects only kept by weak references count as unreachable.
+    """
+
+    def __init__(self, graph, reverse_graph, weak_slots=None):
+        self.graph = graph
+        self.reverse_graph = reverse_graph
+        self.store = store = graph.store
+        self.weak_slots = weak_slots or {}
+
+        # Root type of each root row, GC root records first, then class static fields
+        self.root_kinds = {}
+        for id, kind in zip(store.root_ids, store.root_kinds):
+            row = store.index(id)
+            if row >= 0 and row not in self.root_kinds:
+                self.root_kinds[row] = HEAP_DUMP_SUB_TAGS[kind]
+        for row in graph.root_rows:
+            self.root_kinds.setdefault(row, 'STATIC_FIELD')
+
+        n = graph.n
+        targets = graph.targets
+        edge_offsets = graph.edge_offsets
+        weak_edges = self.weak_edge_slots()
+        distance = array('l', [-1]) * n
+        queue = deque(graph.root_rows)
+        for row in graph.root_rows:
+            distance[row] = 0
+        while queue:
+            row = queue.popleft()
+            d = distance[row] + 1
+            weak = weak_edges[row] if weak_edges is not None else -1
+            start = edge_offsets[row]
+            for e in range(start, edge_offsets[row + 1]):
+                t = targets[e]
+                if t >= 0 and distance[t] < 0 and e - start != weak:
+                    distance[t] = d
+                    queue.append(t)
+        self.distance = distance
+
+    def weak_edge_slots(self):
+        """Slot of the edge not to follow out of each row, -1 for none, or None if there
+        are no such edges
+        """
+        if not self.weak_slots:
+            return None
+        store = self.store
+        class_ids = store.class_ids
+        weak_indexes = dict((i, self.weak_slots[class_id]) for i, class_id in enumerate(class_ids)
+                            if class_id in self.weak_slots)
+        return array('l', (weak_indexes.get(class_index, -1) for class_index in store.class_indexes))
+
+    def is_weak(self, row, slot):
+        class_id = self.store.class_id(row)
+        return class_id is not None and self.weak_slots.get(class_id) == slot
+
+    def distance_from_roots(self, id):
+        """Number of references between a root and an object, None if it is unreachable
+        """
+        row = self.row(id)
+        return self.distance[row] if self.distance[row] >= 0 else None
+
+    def row(self, id):
+        i = self.store.index(id)
+        if i < 0:
+            raise KeyError(id)
+        return i
+
+    def path(self, chain, labels):
+        """[(id, label), ...] of a chain of rows, caching labels by class and slot
+        """
+        ids = self.store.ids
+        class_indexes = self.store.class_indexes
+        path = []
+        label = None
+        while chain is not None:
+            row, slot = chain[0], chain[1]
+            path.append((ids[row], label))
+            if slot is not None:
+                key = (class_indexes[row], slot)
+                try:
+                    label = labels[key]
+                except KeyError:
+                    label = labels[key] = self.reverse_graph.label(row, slot)
+            chain = chain[2]
+        return path
+
+    def shortest_chain(self, target):
+        """A shortest chain to a reachable row, following referrers one step closer to the
+        roots each time
+        """
+        distance = self.distance
+        reverse = self.reverse_graph
+        offsets, referrers, slots = reverse.offsets, reverse.referrers, reverse.slots
+        check_weak = bool(self.weak_slots)
+        chain = (target, None, None)
+        row = target
+        while distance[row] > 0:
+            d = distance[row] - 1
+            for position in range(offsets[row], offsets[row + 1]):
+                referrer = referrers[position]
+                if distance[referrer] == d and not (check_weak and self.is_weak(referrer, slots[position])):
+                    break
+            chain = (referrer, slots[position], chain)
+            row = referrer
+        return chain
+
+    def paths(self, id, k=1):
+        """The k shortest reference chains from a GC root to an object, shortest first, as
+        (root type, [(id, label), ...]) from the root to the object, where each label is the
+        field or array slot of the previous object holding the reference (None for the root)
+        """
+        target = self.row(id)
+        distance = self.distance
+        if distance[target] < 0:
+            return []
+        reverse = self.reverse_graph
+        offsets, referrers, slots = reverse.offsets, reverse.referrers, reverse.slots
+        check_weak = bool(self.weak_slots)
+        labels = {}
+        if k == 1:
+            chain = self.shortest_chain(target)
+            return [(self.root_kinds[chain[0]], self.path(chain, labels))]
+        results = []
+        # Best first search backwards from the object. Partial chains are linked as
+        # (row, slot of the reference to the next row, rest, least distance of their rows)
+        # and are prioritised by their length plus the exact distance of their first row
+        # from the roots, then the longest first, so the shortest chains are followed
+        # straight to a root
+        heap = [(distance[target], 0, 0, (target, None, None, distance[target]))]
+        counter = 1
+        while heap and len(results) < k:
+            _, length, _, chain = heapq.heappop(heap)
+            length = -length
+            row = chain[0]
+            if row in self.root_kinds:
+                results.append((self.root_kinds[row], self.path(chain, labels)))
+                continue
+            least = chain[3]
+            on_chain = None
+            for position in range(offsets[row], offsets[row + 1]):
+                referrer = referrers[position]
+                d = distance[referrer]
+                if d < 0:
+                    continue
+                if d >= least:
+                    # Only rows at least this far from the roots can already be on the chain
+                    if on_chain is None:
+                        on_chain = set()
+                        c = chain
+                        while c is not None:
+                            on_chain.add(c[0])
+                            c = c[2]
+                    if referrer in on_chain:
+                        continue
+                if check_weak and self.is_weak(referrer, slots[position]):
+                    continue
+                heapq.heappush(heap, (length + 1 + d, -length - 1, counter,
+                                      (referrer, slots[position], chain, d if d < least else least)))
+                counter += 1
+        return results
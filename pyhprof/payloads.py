@@ -0,0 +1,40 @@
+"""On-demand loading of primitive array payloads, so that parsed arrays only need to
+remember where their data is.
+"""
+
+from collections import OrderedDict
+
+
+class PayloadLoader(object):
+    """Reads payload bytes by file offset through an HProfParser.
+
+    Memory mapped parsers return zero-copy slices of the mapping. Otherwise the bytes
+    are read from the file, and the most recently used payloads are kept in an LRU
+    cache of at most `budget` bytes (0 disables the cache).
+    """
+
+    def __init__(self, parser, budget=0):
+        self.parser = parser
+        self.budget = budget
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+
+    def load(self, offset, length):
+        if self.parser.mapped:
+            return self.parser.f.buf[offset:offset + length]
+        try:
+            data = self.cache[offset]
+        except KeyError:
+            pass
+        else:
+            self.cache.move_to_end(offset)
+            return data
+        with self.parser.goto(offset):
+            data = self.parser.read(length)
+        if length <= self.budget:
+            self.cache[offset] = data
+            self.cached_bytes += length
+            while self.cached_bytes > self.budget:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+        return data
@@ -0,0 +1,141 @@
+"""Queries on the instances of a class, answered from the sidecar index by decoding only
+the records they return.
+"""
+
+from itertools import islice
+
+from .index import HProfIndex
+from .parsers import HProfParser, HeapDumpParser
+from .references import InstanceLayout, InstanceReference, JavaClass
+
+
+class HeapQuery(object):
+    """Instance queries on a dump, backed by its HProfIndex (built and written next to the
+    dump the first time, see HProfIndex.open).
+
+    Class names are given as in the dump ('java/lang/String') or with dots. Results are
+    InstanceReferences whose children are the ids of their object fields, in file order,
+    and can be paged through with `start` and `stop`, which skip the records before
+    `start` without reading them.
+    """
+
+    def __init__(self, f, use_mmap=False, index_path=None):
+        self.p = HProfParser(f, use_mmap)
+        self.index = HProfIndex.open(self.p, index_path)
+        self.strings = self.index.strings
+        # Reused to read single records at their offsets
+        self.hp = HeapDumpParser(self.p.f, self.p.id_size)
+        self._classes = None
+        self._subclass_ids = None
+        self.layouts = {}
+
+    @property
+    def classes(self):
+        """JavaClass of every class dump, by id, read from the dump the first time
+        """
+        if self._classes is None:
+            classes = {}
+            for class_id, offset in sorted(self.index.class_offsets.items(), key=lambda item: item[1]):
+                c = self.read_record(offset)
+                name = self.strings.get(self.index.class_name_ids.get(c.id))
+                classes[c.id] = JavaClass(c.id, name, c.super_class_id, c.instance_fields, c.static_fields,
+                                          c.constants_pool)
+            self._classes = classes
+        return self._classes
+
+    def read_record(self, offset):
+        self.hp.f.seek(offset)
+        return self.hp.read_next_block()
+
+    def class_ids(self, name, subclasses=False):
+        """Ids of the classes with this name (one per class loader), and optionally of all
+        their subclasses
+        """
+        name = name.replace('.', '/')
+        ids = [id for id, c in self.classes.items() if c.name == name]
+        if not subclasses:
+            return ids
+        if self._subclass_ids is None:
+            self._subclass_ids = {}
+            for id, c in self.classes.items():
+                self._subclass_ids.setdefault(c.parent_class_id, []).append(id)
+        found = []
+        pending = list(ids)
+        while pending:
+            id = pending.pop()
+            found.append(id)
+            pending.extend(self._subclass_ids.get(id, ()))
+        return found
+
+    def layout(self, class_id):
+        """InstanceLayout of a class, or None if a class in its chain is not in the dump or
+        the name of one of its object fields is unknown
+        """
+        try:
+            return self.layouts[class_id]
+        except KeyError:
+            pass
+        fields = []
+        try:
+            c = self.classes[class_id]
+            while True:
+                fields.extend(c.instance_fields)
+                if not c.parent_class_id:
+                    break
+                c = self.classes[c.parent_class_id]
+            layout = InstanceLayout(self.p.structs, self.strings, fields)
+        except KeyError:
+            layout = None
+        self.layouts[class_id] = layout
+        return layout
+
+    def instance_offsets(self, name, subclasses=False):
+        """Offsets of the instances of a class, skipping the classes without a layout
+        """
+        for class_id in self.class_ids(name, subclasses):
+            if self.layout(class_id) is None:
+                continue
+            for offset in self.index.instances_of(class_id):
+                yield offset
+
+    def count(self, name, subclasses=False):
+        """Number of instances of a class, from the index alone
+        """
+        return sum(len(self.index.instances_of(class_id)) for class_id in self.class_ids(name, subclasses))
+
+    def instance(self, offset):
+        """InstanceReference of the INSTANCE_DUMP record at a file offset
+        """
+        el = self.read_record(offset)
+        return InstanceReference.build_from_instance_dump(self.layout(el.class_object_id),
+                                                          self.classes.get(el.class_object_id), el)
+
+    def instances(self, name, subclasses=False, start=0, stop=None):
+        """Instances of a class, and optionally of its subclasses
+        """
+        for offset in islice(self.instance_offsets(name, subclasses), start, stop):
+            yield self.instance(offset)
+
+    def referencing(self, name, field, id, subclasses=False, start=0, stop=None):
+        """Instances of a class whose field `field` holds the object id `id`. Only the field
+        is unpacked from each record
+        """
+        matches = (offset for offset in self.instance_offsets(name, subclasses)
+                   if self.field_value(offset, field) == id)
+        for offset in islice(matches, start, stop):
+            yield self.instance(offset)
+
+    def field_value(self, offset, field):
+        """Value of the named object field of the INSTANCE_DUMP record at a file offset, or
+        None if its class has no such field
+        """
+        el = self.read_record(offset)
+        layout = self.layout(el.class_object_id)
+        if layout is None:
+            return None
+        try:
+            # The first field with the name hides those of super classes
+            i = layout.names.index(field)
+        except ValueError:
+            return None
+        return layout.ids(el.bytes)[i]
@@ -18,7 +18,7 @@ def hash_map_get_elements(r):
     except KeyError:
         return generic_get_elements(r)
     acc = []
-    for e in table.children.itervalues():
+    for e in table.children.values():
         if e is None:
             continue
         try:
@@ -46,8 +46,10 @@ COLLECTION_ELEMENT_ACCESSORS = {
 
 class ReferenceGraphBuilder(object):
     def __init__(self, root_reference, max_depth=6, collection_element_accessors=COLLECTION_ELEMENT_ACCESSORS,
-                 min_size=1e5, max_name_characters=16):
+                 min_size=1e5, max_name_characters=16, dominator_tree=None):
         self.root_reference = root_reference
+        # With a DominatorTree nodes are sized by retained size rather than a deep size BFS each
+        self.dominator_tree = dominator_tree
         self.max_depth = max_depth
         self.collection_element_accessors = collection_element_accessors
         self.min_size = min_size
@@ -95,7 +97,11 @@ class ReferenceGraphBuilder(object):
         try:
             return self.sizes[r]
         except KeyError:
-            self.sizes[r] = s = r.compute_deep_size()
+            if self.dominator_tree is not None:
+                s = self.dominator_tree.retained_size(r.id) or 0
+            else:
+                s = r.compute_deep_size()
+            self.sizes[r] = s
             return s
 
     def make_arc(self, parent, child, label):
@@ -107,7 +113,7 @@ class ReferenceGraphBuilder(object):
         g = 255 * (1 - f)
         b = 20
         a = 0xff * 0.5
-        color = '#%02X%02X%02X%02X' % (r, g, b, a)
+        color = '#%02X%02X%02X%02X' % (int(r), int(g), int(b), int(a))
         self.lines.append('%d [label="%s (%s)" shape=%s style=filled color="%s"];' % (self.ref_name(node), label,
                                                                                       self.mem_str(self.get_size(node)),
                                                                                       shape, color))
@@ -155,5 +161,5 @@ class ReferenceGraphBuilder(object):
         self.make_node(r, name)
 
         if not isinstance(r, ObjectArrayReference) and depth < self.max_depth:
-            for n, c in sorted(r.children.iteritems()):
+            for n, c in sorted(r.children.items()):
                 self.rec(c, depth + 1, r, n)
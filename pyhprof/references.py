@@ -3,28 +3,53 @@ Primarily for computing the deep (i.e. retained) size of objects, which includes
 size of objects they reference.
 """
 
-import struct
+import multiprocessing
+import os
+import queue
+import threading
+from bisect import bisect_right
 from collections import deque
+from contextlib import nullcontext
 from hexdump import hexdump
 import re
 
-from .constants import ARRAY_OVERHEAD, TYPE_SIZES
+from .constants import ARRAY_OVERHEAD, TYPE_STRUCT_CODES
 from .parsers import HProfParser, HeapDumpParser
-from .heap_blocks import ClassDump, InstanceDump, ObjectArrayDump, PrimitiveArrayDump
+from .blocks import HeapDump
+from .heap_blocks import ClassDump, InstanceDump, ObjectArrayDump, PrimitiveArrayDump, ROOT_TAGS_BY_CLASS
+from .store import ObjectStore, KIND_CODES
+from .index import HProfIndex, file_fingerprint
+from .graph import ObjectGraph, ReverseGraph
+from .dominators import DominatorTree
+from .paths import GCRootPaths, referent_slots
+from .payloads import PayloadLoader
+from .compressed import CompressedFile, is_compressed
+from .instrumentation import Instrumentation
+from .secret_scanner import SecretHit
 
 
-# TODO: Make this code worth with either id sizes of 4 or 8
-ID_SIZE = 8
+# Number of preceding records the variable heuristics look at
+VARIABLE_LOOKBEHIND = 3
+# Sub-records built in variables_only mode, the heuristics only need the class of the others
+VARIABLE_TAGS = ('PRIMITIVE_ARRAY_DUMP',)
+
+INSTANCE_DUMP = KIND_CODES['INSTANCE_DUMP']
+OBJECT_ARRAY_DUMP = KIND_CODES['OBJECT_ARRAY_DUMP']
+PRIMITIVE_ARRAY_DUMP = KIND_CODES['PRIMITIVE_ARRAY_DUMP']
 
 
 class BaseReference(object):
+    # __weakref__ lets ObjectStore cache built references weakly
+    __slots__ = ('base_size', 'children', '__weakref__')
+
     def __init__(self, base_size, children=None):
         self.base_size = base_size
         self.children = children or {}
 
     def resolve_children(self, references):
-        for k in self.children.keys():
-            self.children[k] = references.get(self.children[k])
+        ids = self.children
+        keys = ids.keys() if isinstance(ids, dict) else range(len(ids))
+        self.children = dict((k, references.get(ids[k])) for k in keys)
 
     def bfs_transverse(self):
         seen = {self}
@@ -34,7 +59,7 @@ class BaseReference(object):
             yield n
             for child in n.children.values():
                 if child is not None and child not in seen:
-                    seen.add(n)
+                    seen.add(child)
                     queue.append(child)
 
     def count_deep_children(self):
@@ -63,7 +88,40 @@ class JavaClass(object):
         return self.name.rsplit('/', 1)[-1]
 
 
+class InstanceLayout(object):
+    """The instance fields of a class followed by those of its super classes, in the order
+    of INSTANCE_DUMP records, compiled into a single struct. `id_struct` has the same size
+    but only unpacks the object fields, whose names are `names`
+    """
+
+    __slots__ = ('fields', 'struct', 'id_struct', 'names', 'shadowed')
+
+    def __init__(self, structs, names, fields):
+        self.fields = fields
+        codes = [TYPE_STRUCT_CODES[tp] for name_id, tp in fields]
+        self.struct = structs['>' + ''.join(codes)]
+        self.id_struct = structs['>' + ''.join(code if code == 'O' else '%dx' % structs['>' + code].size
+                                               for code in codes)]
+        self.names = [names[name_id] for name_id, tp in fields if tp == 'OBJECT']
+        # Whether a field hides a super class field of the same name
+        self.shadowed = len(set(self.names)) != len(self.names)
+
+    def ids(self, data):
+        """Ids of all the object fields of an instance's data, hidden ones included
+        """
+        return self.id_struct.unpack(data)
+
+    def children(self, data):
+        """{field name: id} of the object fields of an instance's data
+        """
+        if self.shadowed:
+            return dict(reversed(list(zip(self.names, self.id_struct.unpack(data)))))
+        return dict(zip(self.names, self.id_struct.unpack(data)))
+
+
 class InstanceReference(BaseReference):
+    __slots__ = ('id', 'cls', 'bytes')
+
     def __init__(self, id, cls, base_size, fields, bytes):
         super(InstanceReference, self).__init__(base_size, fields)
         self.id = id
@@ -71,22 +129,13 @@ class InstanceReference(BaseReference):
         self.bytes = bytes
 
     @classmethod
-    def build_from_instance_dump(cls, strings, instance_cls, instance):
-        id = ''
-        try:
-            offset = 0
-            fields = {}
-            for name_id, tp in instance_cls.instance_fields:
-                if tp == 'OBJECT':
-                    id = struct.unpack('>Q', instance.bytes[offset:offset + ID_SIZE])[0]
-                    name = strings[name_id]
-                    fields[name] = id
-                    offset += ID_SIZE
-                else:
-                    offset += TYPE_SIZES[tp]
-            return cls(id, instance_cls, len(instance.bytes), fields, instance.bytes)
-        except:
-            pass
+    def build_from_instance_dump(cls, layout, instance_cls, instance):
+        """Build a reference from an InstanceDump of `instance_cls` with its InstanceLayout.
+        Returns None if the instance data does not match the layout
+        """
+        if layout is None or layout.struct.size != len(instance.bytes):
+            return None
+        return cls(instance.id, instance_cls, len(instance.bytes), layout.children(instance.bytes), instance.bytes)
 
     def __str__(self):
         return 'Instance<%s>' % self.cls.name
@@ -96,10 +145,16 @@ class InstanceReference(BaseReference):
 
 
 class ObjectArrayReference(BaseReference):
+    """An object array. Its children are the typed array of element ids (of the dump's id
+    size) until it is loaded from an ObjectStore, which maps element indexes to references
+    """
+
+    __slots__ = ('id',)
+
     def __init__(self, id, elements):
         super(ObjectArrayReference, self).__init__(
-            ARRAY_OVERHEAD + len(elements) * ID_SIZE,
-            {i: el for i, el in enumerate(elements)}
+            ARRAY_OVERHEAD + len(elements) * elements.itemsize,
+            elements
         )
         self.id = id
 
@@ -112,7 +167,13 @@ class ObjectArrayReference(BaseReference):
 
 
 class PrimitiveArrayReference(BaseReference):
-    def __init__(self, id, element_type, element_size, number_of_elements, data):
+    """A primitive array. When built with `data` None, only the file offset of the data
+    is kept, and it is read through `loader` (a PayloadLoader) each time it is needed
+    """
+
+    __slots__ = ('id', 'element_type', 'element_size', 'number_of_elements', '_data', 'data_offset', 'loader')
+
+    def __init__(self, id, element_type, element_size, number_of_elements, data, data_offset=None, loader=None):
         super(PrimitiveArrayReference, self).__init__(
             ARRAY_OVERHEAD + element_size * number_of_elements
         )
@@ -120,7 +181,15 @@ class PrimitiveArrayReference(BaseReference):
         self.element_type = element_type
         self.element_size = element_size
         self.number_of_elements = number_of_elements
-        self.data = data
+        self._data = data
+        self.data_offset = data_offset
+        self.loader = loader
+
+    @property
+    def data(self):
+        if self._data is None and self.loader is not None:
+            return self.loader.load(self.data_offset, self.element_size * self.number_of_elements)
+        return self._data
 
     def __str__(self):
         return '%s Array Length %d' % (self.element_type, self.number_of_elements)
@@ -135,70 +204,576 @@ class PrimitiveArrayReference(BaseReference):
         hexdump(self.data)
 
     def ascii_data(self):
-        # Ascii is [^\x00-\x7f], but printable is 0x20-0x7e
-        ascii_str = re.sub(b'[^\x0a\x0d\x20-\x7e]',b'',bytes(self.data))
-        return ascii_str
+        return ascii_data(self.data)
+
+    def ascii_offset(self, offset):
+        """Offset in the array's contents of the byte at `offset` in ascii_data()
+        """
+        return ascii_offset(self.data, offset)
+
+
+class BuildCancelled(Exception):
+    """Raised inside a build whose results() generator was abandoned, to unwind it
+    """
+
+
+def record_class(el):
+    """Class of a record, or the record itself if it was skipped (see HeapDumpParser.want)
+    """
+    return el if isinstance(el, type) else type(el)
+
+
+def ascii_data(data):
+    # Ascii is [^\x00-\x7f], but printable is 0x20-0x7e
+    ascii_str = re.sub(b'[^\x0a\x0d\x20-\x7e]',b'',bytes(data))
+    return ascii_str
+
+
+ASCII_RUNS = re.compile(b'[\x0a\x0d\x20-\x7e]+')
+
+
+def ascii_offset(data, offset):
+    """Offset in `data` of the byte at `offset` in ascii_data(data)
+    """
+    for m in ASCII_RUNS.finditer(bytes(data)):
+        n = m.end() - m.start()
+        if offset < n:
+            return m.start() + offset
+        offset -= n
+    return len(data)
 
 
 class ReferenceBuilder(object):
     def __init__(self, f, flags={}):
         self.f = f
+        self.flags = flags
         self.strings = {}
         self.class_name_ids = {}
         self.classes = {}
-        self.references = {}
+        self.references = ObjectStore(self.load_reference)
+        # InstanceLayout of each class, by class id
+        self.layouts = {}
+        # Whether a layout is None because a class dump was missing
+        self.missing_layouts = False
         self.variables = {}
         self.variable_type = 0
+        self.use_mmap = flags.get('mmap', False)
+        self.use_index = flags.get('index', False)
+        self.index = None
+        self._object_graph = None
+        self._reverse_graph = None
+        self._gc_root_paths = {}
+        self._dominator_tree = None
+        self.workers = flags.get('workers', 1)
+        self.chunk_size = flags.get('chunk_size', 64 * 2 ** 20)
+        self.lazy_arrays = flags.get('lazy_arrays', False)
+        self.payload_cache = flags.get('payload_cache', 0)
+        self.payloads = None
+        # None detects compressed dumps by their magic number
+        self.compressed = flags.get('compressed')
+        self.checkpoint_interval = flags.get('checkpoint_interval')
+        self.scanner = flags.get('scanner')
+        self.instrumentation = flags.get('instrumentation')
+        self.inspect_arrays = flags.get('inspect_arrays', False)
+        # HeapCache of parsed dumps. Cached dumps are not parsed again, so with a cache the
+        # first build of a dump builds every reference, to be cached
+        self.cache = flags.get('cache')
+        self.fingerprint = None
+        self.cached = False
+        # Only look for variables and array results, skipping everything but primitive
+        # arrays and building no references
+        self.variables_only = flags.get('variables_only', False) and self.cache is None
+        if self.variables_only:
+            self.add_reference = self.add_array
+        self.callbacks = []
+        self.last_item = None
+        # Collect variable candidates, as ('candidate', (key, value, layout)), and results in
+        # the order they are found instead of recording them, in segment workers
+        self.events = None
+        # Set when the consumer of results() goes away
+        self.cancelled = threading.Event()
         if flags['type_one']:
             self.variable_type = 1
         elif flags['type_two']:
             self.variable_type = 2
 
     def build(self, mx=None):
-        heap_dumps = self.read_hprof()
-        self.read_references(heap_dumps, mx)
-        for c in self.classes.values():
-            c.parent_class = self.references.get(c.parent_class_id)
-        for r in self.references.values():
-            r.resolve_children(self.references)
+        with self.phase('scan'):
+            heap_dumps = self.read_hprof(mx)
+        with self.phase('references', sum(block.length for block in heap_dumps)):
+            if self.cached:
+                self.read_cached_references(heap_dumps)
+            else:
+                self.read_references(heap_dumps, mx)
+        with self.phase('resolve'):
+            for c in self.classes.values():
+                c.parent_class = self.references.get(c.parent_class_id)
+        if self.fingerprint is not None and not self.cached:
+            with self.phase('cache'):
+                self.cache.save(self.fingerprint, self.p.structs, self.strings, self.class_name_ids, self.classes,
+                                self.references, heap_dumps)
         return self.references.values()
 
-    def read_hprof(self):
-        self.p = HProfParser(self.f)
+    def phase(self, name, total_bytes=None):
+        """Context timing a phase of the build in the 'instrumentation' flag's Instrumentation
+        """
+        if self.instrumentation is None:
+            return nullcontext()
+        return self.instrumentation.phase(name, total_bytes)
+
+    def on_result(self, callback):
+        """Call `callback(kind, result)` for every result as soon as it is found while
+        building. Results are ('variable', (key, value)), ('http', (id, data)) for primitive
+        arrays holding HTTP/1.1 traffic and ('secret', (SecretHit, data)) for matches of the
+        'scanner' flag's SecretScanner, with data the ASCII contents of the array. Hit
+        offsets are into the array's contents as dumped
+        """
+        self.callbacks.append(callback)
+        self.inspect_arrays = True
+
+    def results(self, mx=None):
+        """Run build() in a background thread, yielding (kind, result) pairs as they are
+        found (see on_result). If the generator is closed early the build stops at its next
+        result or heap dump block
+        """
+        results = queue.Queue(1024)
+        done = object()
+        error = []
+
+        def run():
+            try:
+                self.build(mx)
+            except BuildCancelled:
+                pass
+            except BaseException as e:
+                error.append(e)
+            finally:
+                results.put(done)
+
+        self.on_result(lambda kind, result: results.put((kind, result)))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        finished = False
+        try:
+            while True:
+                item = results.get()
+                if item is done:
+                    finished = True
+                    break
+                yield item
+        finally:
+            if not finished:
+                self.cancelled.set()
+                # Unblock a put() in progress, leaving room for the last result and `done`
+                while True:
+                    try:
+                        results.get_nowait()
+                    except queue.Empty:
+                        break
+        thread.join()
+        if error:
+            raise error[0]
+
+    def emit(self, kind, result):
+        if self.cancelled.is_set():
+            raise BuildCancelled()
+        if self.events is not None:
+            self.events.append((kind, result))
+            return
+        for callback in self.callbacks:
+            callback(kind, result)
+
+    def object_graph(self):
+        if self._object_graph is None:
+            self._object_graph = ObjectGraph(self.references, self.classes)
+        return self._object_graph
+
+    def reverse_graph(self):
+        """Inbound references of every object built, labelled with field names. Computed once
+        """
+        if self._reverse_graph is None:
+            with self.phase('reverse'):
+                self._reverse_graph = ReverseGraph(self.object_graph(), self.field_names)
+        return self._reverse_graph
+
+    def gc_root_paths(self, exclude_weak=False):
+        """GCRootPaths of every object built, optionally not following the referents of
+        java.lang.ref.Reference objects. Computed once for each setting
+        """
+        paths = self._gc_root_paths.get(exclude_weak)
+        if paths is None:
+            reverse_graph = self.reverse_graph()
+            with self.phase('root paths'):
+                weak_slots = referent_slots(self.classes, self.field_names) if exclude_weak else None
+                paths = self._gc_root_paths[exclude_weak] = GCRootPaths(self.object_graph(), reverse_graph,
+                                                                        weak_slots)
+        return paths
+
+    def field_names(self, class_id):
+        """Names of the object fields of a class's instances, in the order of their edges
+        """
+        layout = self.instance_layout(class_id)
+        return layout and layout.names
+
+    def dominator_tree(self):
+        """Dominator tree over every object built, giving retained sizes. Computed once
+        """
+        if self._dominator_tree is None:
+            with self.phase('dominators'):
+                self._dominator_tree = DominatorTree(self.object_graph())
+        return self._dominator_tree
+
+    def read_hprof(self, mx=None):
+        """Read the string and class tables, returning the heap dump blocks. Compressed
+        dumps are read front to back in one pass, parsing the heap dumps (with `mx`) as they
+        are reached, so none are returned and the index, workers and lazy arrays are not used
+        """
+        if self.compressed is None:
+            self.compressed = is_compressed(self.f)
+        if self.compressed:
+            self.p = HProfParser(CompressedFile(self.f, self.checkpoint_interval))
+            self.lazy_arrays = False
+        else:
+            self.p = HProfParser(self.f, self.use_mmap)
+        self.payloads = PayloadLoader(self.p, self.payload_cache)
+        self.references = ObjectStore(self.load_reference, self.p.id_size)
+        if self.instrumentation is not None:
+            self.p.instrument(self.instrumentation)
+            if not self.compressed:
+                self.instrumentation.total_bytes = os.fstat(self.f.fileno()).st_size
+        if self.cache is not None and mx is None and not self.compressed:
+            self.fingerprint = file_fingerprint(self.p)
+            cached = self.cache.load(self.fingerprint, self.p.structs, self.load_reference)
+            if cached is not None:
+                return self.load_cached(cached)
+        if self.use_index and not self.compressed:
+            # The index replaces the scan of the top-level records; the heap dumps are still
+            # parsed in full, as the variable heuristics need their records in order
+            self.index = HProfIndex.open(self.p)
+            self.strings.update(self.index.strings)
+            self.class_name_ids.update(self.index.class_name_ids)
+            return self.index.heap_dumps(self.p)
         heapdump_blocks = []
         for b in self.p:
             if b.tag_name == 'HEAP_DUMP' or b.tag_name == 'HEAP_DUMP_SEGMENT':
-                heapdump_blocks.append(b)
+                if self.compressed:
+                    self.read_heap_dump(b, mx)
+                else:
+                    heapdump_blocks.append(b)
             elif b.tag_name == 'STRING':
                 self.strings[b.id] = b.contents
             elif b.tag_name == 'LOAD_CLASS':
                 self.class_name_ids[b.class_id] = b.class_name_id
         return heapdump_blocks
 
+    def load_cached(self, cached):
+        """Take the tables and references of a HeapCache entry, returning the heap dump blocks
+        """
+        strings, class_name_ids, classes, self.references, heap_dumps = cached
+        self.strings.update(strings)
+        self.class_name_ids.update(class_name_ids)
+        self.classes.update((c[0], JavaClass(*c)) for c in classes)
+        self.cached = True
+        return [HeapDump(tag, self.p, record_time, start, length) for tag, record_time, start, length in heap_dumps]
+
+    def dump_path(self):
+        """Path workers can reopen the dump at, or None for file objects without one (pipes,
+        in-memory files, descriptors)
+        """
+        name = getattr(self.f, 'name', None)
+        if isinstance(name, str) and os.path.isfile(name):
+            return name
+        return None
+
     def read_references(self, heap_dumps, mx=None):
-        blockCount = 0
+        if self.workers > 1 and self.dump_path() is not None:
+            chunks = self.split_heap_dumps(heap_dumps)
+            if len(chunks) > 1:
+                self.read_references_parallel(chunks, mx)
+                return
+        for block in heap_dumps:
+            self.read_heap_dump(block, mx)
+
+    def split_heap_dumps(self, heap_dumps):
+        """Pieces of the heap dumps that can be parsed independently, as tuples of
+        (block, first_index, lookbehind_start). Blocks longer than `chunk_size` (such as a
+        single monolithic HEAP_DUMP) are split on record boundaries by a skip-only pre-scan.
+        """
+        chunks = []
         for block in heap_dumps:
-            # print("Inspecting block %d" % blockCount)
-            self.f.seek(block.start)
-            p = HeapDumpParser(self.f, ID_SIZE, block.length)
-
-            references = []
-            for i, el in enumerate(p):
-                references.append(el)
-
-            if self.variable_type == 0:
-                if b'1.0.2' in self.p.format:
-                    self.parse_type_two_references(block, mx, p, references)
-                elif b'1.0.1' in self.p.format:
-                    self.parse_type_one_references(block, mx, p, references)
+            if block.length <= self.chunk_size:
+                chunks.append((block, 0, block.start))
+                continue
+            with self.p.goto(block.start):
+                p = HeapDumpParser(self.p.f, self.p.id_size, block.length)
+                for start, length, first_index, lookbehind_start in p.split(self.chunk_size, VARIABLE_LOOKBEHIND):
+                    chunk = HeapDump(block.tag, self.p, block.record_time, start, length)
+                    chunks.append((chunk, first_index, lookbehind_start))
+        return chunks
+
+    def read_heap_dump(self, block, mx=None, first_index=0, lookbehind_start=None):
+        """Parse a heap dump block, or a chunk of one that starts `first_index` records in.
+        The records from `lookbehind_start` up to the chunk only seed the variable heuristics.
+        """
+        if self.cancelled.is_set():
+            raise BuildCancelled()
+        if lookbehind_start is None:
+            lookbehind_start = block.start
+        self.p.f.seek(lookbehind_start)
+        p = HeapDumpParser(self.p.f, self.p.id_size, block.start + block.length - lookbehind_start,
+                           lazy_payloads=self.lazy_arrays,
+                           wanted=VARIABLE_TAGS if self.variables_only else None)
+        window = [p.read_next_block() for _ in range(min(VARIABLE_LOOKBEHIND, first_index))]
+        if self.instrumentation is not None:
+            p.instrument(self.instrumentation)
+        if first_index == 0:
+            self.last_item = None
+
+        # Records are streamed straight from the parser, the variable heuristics only
+        # keep a bounded window of the preceding records
+        if self.variable_type == 0:
+            if b'1.0.2' in self.p.format:
+                self.parse_type_two_references(block, mx, p, p, first_index, window)
+            elif b'1.0.1' in self.p.format:
+                self.parse_type_one_references(block, mx, p, p, first_index, window)
+            else:
+                raise ValueError("Error: Unhandled HPROF format: " + self.p.format)
+        elif self.variable_type == 1:
+            self.parse_type_one_references(block, mx, p, p, first_index, window)
+        elif self.variable_type == 2:
+            self.parse_type_two_references(block, mx, p, p, first_index, window)
+
+    def read_references_parallel(self, chunks, mx=None):
+        """Parse heap dump chunks in a pool of `workers` processes, merging their results
+        in order so the outcome matches read_references.
+
+        The first chunk is parsed here, since it usually holds the class dumps that
+        instances in later chunks need. A chunk that references classes first dumped in
+        another later chunk is re-parsed here once its predecessors are merged.
+        """
+        block, first_index, lookbehind_start = chunks[0]
+        self.read_heap_dump(block, mx, first_index, lookbehind_start)
+        flags = dict(self.flags, workers=1, index=False, cache=None, variables_only=self.variables_only,
+                     inspect_arrays=self.inspect_arrays,
+                     instrumentation=self.instrumentation and Instrumentation())
+        pool = multiprocessing.Pool(self.workers, init_segment_worker,
+                                    (self.dump_path(), flags, self.strings, self.class_name_ids, self.classes))
+        try:
+            segments = [(block.start, block.length, first_index, lookbehind_start, mx)
+                        for block, first_index, lookbehind_start in chunks[1:]]
+            for (block, first_index, lookbehind_start), result in zip(chunks[1:], pool.imap(parse_segment, segments)):
+                if result is None:
+                    self.read_heap_dump(block, mx, first_index, lookbehind_start)
+                    continue
+                classes, references, events, instrumentation = result
+                self.classes.update(classes)
+                self.references.merge(references)
+                if instrumentation is not None:
+                    self.instrumentation.merge(instrumentation)
+                    self.instrumentation.advance(block.length)
+                if first_index == 0:
+                    self.last_item = None
+                for kind, event in events:
+                    if kind == 'candidate':
+                        self.add_variable_candidate(*event)
+                    else:
+                        self.emit(kind, event)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def read_cached_references(self, heap_dumps):
+        """Find the variables and array results of a dump loaded from the cache without
+        parsing it, replaying parse_type_one_references or parse_type_two_references over
+        the stored rows in file order. Records that are not stored (class dumps and GC roots)
+        show up as gaps between the end of a row's record and the start of the next
+        """
+        variable_type = self.variable_type
+        if variable_type == 0:
+            if b'1.0.2' in self.p.format:
+                variable_type = 2
+            elif b'1.0.1' in self.p.format:
+                variable_type = 1
+            else:
+                raise ValueError("Error: Unhandled HPROF format: " + self.p.format)
+        store = self.references
+        id_size = store.id_size
+        offsets, sizes, kinds, edge_offsets = store.offsets, store.sizes, store.kinds, store.edge_offsets
+        # Record header sizes, tag included
+        object_header = 1 + 2 * id_size + 8
+        array_header = 1 + id_size + 9
+        starts = sorted(block.start for block in heap_dumps)
+
+        def raw_payload(row):
+            return self.payloads.load(offsets[row] + array_header, sizes[row] - ARRAY_OVERHEAD)
+
+        def payload(row):
+            return ascii_data(raw_payload(row))
+
+        window = deque(maxlen=3)
+        block = None
+        end = None
+        i = 0
+        for row in range(len(store)):
+            offset = offsets[row]
+            b = bisect_right(starts, offset) - 1
+            if b != block:
+                block = b
+                end = starts[b]
+                window.clear()
+                i = 0
+                self.last_item = None
+            if offset != end:
+                window.append(None)
+                i += 1
+            kind = kinds[row]
+            if kind == INSTANCE_DUMP:
+                end = offset + object_header + sizes[row]
+            elif kind == OBJECT_ARRAY_DUMP:
+                end = offset + object_header + (edge_offsets[row + 1] - edge_offsets[row]) * id_size
+            else:
+                end = offset + array_header + sizes[row] - ARRAY_OVERHEAD
+                value = None
+                if self.inspect_arrays:
+                    raw = raw_payload(row)
+                    value = ascii_data(raw)
+                    self.inspect_array(store.ids[row], value, raw)
+                if variable_type == 1:
+                    matched = i >= 2 and window[-2] is not None and window[-1] is not None and \
+                        kinds[window[-2]] == PRIMITIVE_ARRAY_DUMP and kinds[window[-1]] == INSTANCE_DUMP
                 else:
-                    raise ValueError("Error: Unhandled HPROF format: " + self.p.format)
-            elif self.variable_type == 1:
-                self.parse_type_one_references(block, mx, p, references)
-            elif self.variable_type == 2:
-                self.parse_type_two_references(block, mx, p, references)
-
-            blockCount += 1
+                    matched = i >= 4 and None not in window and kinds[window[0]] == PRIMITIVE_ARRAY_DUMP and \
+                        kinds[window[1]] == INSTANCE_DUMP and kinds[window[2]] == INSTANCE_DUMP
+                if matched:
+                    key = payload(window[-2] if variable_type == 1 else window[0])
+                    if value is None:
+                        value = payload(row)
+                    if key.strip() != b'' and value.strip() != b'':
+                        self.add_variable_candidate(key, value, variable_type)
+            window.append(row)
+            i += 1
+
+    def make_reference(self, p, el):
+        if isinstance(el, InstanceDump):
+            return InstanceReference.build_from_instance_dump(
+                self.instance_layout(el.class_object_id),
+                self.classes.get(el.class_object_id),
+                el
+            )
+        elif isinstance(el, ObjectArrayDump):
+            return ObjectArrayReference(el.id, el.elements)
+        elif isinstance(el, PrimitiveArrayDump):
+            return PrimitiveArrayReference(el.id, el.element_type, p.type_size(el.element_type), el.size, el.data,
+                                           el.data_offset, self.payloads)
+
+    def instance_layout(self, class_id):
+        """InstanceLayout of a class, compiled the first time, or None if a class in its
+        chain is not dumped (yet) or the name of one of its object fields is unknown
+        """
+        try:
+            return self.layouts[class_id]
+        except KeyError:
+            pass
+        fields = []
+        try:
+            c = self.classes[class_id]
+            while True:
+                fields.extend(c.instance_fields)
+                if not c.parent_class_id:
+                    break
+                c = self.classes[c.parent_class_id]
+        except KeyError:
+            # Retried if the class dump turns up later, see add_reference
+            self.missing_layouts = True
+            layout = None
+        else:
+            try:
+                layout = InstanceLayout(self.p.structs, self.strings, fields)
+            except KeyError:
+                layout = None
+        self.layouts[class_id] = layout
+        return layout
+
+    def load_reference(self, offset):
+        with self.p.goto(offset):
+            p = HeapDumpParser(self.p.f, self.p.id_size, lazy_payloads=self.lazy_arrays)
+            return self.make_reference(p, p.read_next_block())
+
+    def array_data(self, el):
+        """Payload of a PrimitiveArrayDump, loaded from the dump if it was parsed lazily
+        """
+        if el.data is None:
+            return self.payloads.load(el.data_offset, self.p.type_size(el.element_type) * el.size)
+        return el.data
+
+    def add_reference(self, p, el):
+        if isinstance(el, ClassDump):
+            self.classes[el.id] = JavaClass(el.id, self.strings[self.class_name_ids[el.id]],
+                                            el.super_class_id,
+                                            el.instance_fields, el.static_fields, el.constants_pool)
+            if self.missing_layouts:
+                self.layouts = dict((id, layout) for id, layout in self.layouts.items() if layout is not None)
+                self.missing_layouts = False
+            return
+        root_tag = ROOT_TAGS_BY_CLASS.get(type(el))
+        if root_tag is not None:
+            self.references.add_root(el.id, root_tag)
+            return
+        if isinstance(el, InstanceDump):
+            # Only the ids of the object fields are needed, not a reference
+            layout = self.instance_layout(el.class_object_id)
+            if layout is None or layout.struct.size != len(el.bytes):
+                self.references.add(el.id, 'INSTANCE_DUMP', el.class_object_id, p.record_start, len(el.bytes))
+            else:
+                self.references.add(el.id, 'INSTANCE_DUMP', el.class_object_id, p.record_start, len(el.bytes),
+                                    layout.ids(el.bytes))
+            return
+        r = self.make_reference(p, el)
+        if isinstance(el, ObjectArrayDump):
+            self.references.add(el.id, 'OBJECT_ARRAY_DUMP', el.array_class_object_id, p.record_start, r.base_size,
+                                el.elements)
+        elif isinstance(el, PrimitiveArrayDump):
+            self.references.add(el.id, 'PRIMITIVE_ARRAY_DUMP', el.element_type, p.record_start, r.base_size)
+            if self.inspect_arrays:
+                raw = self.array_data(el)
+                self.inspect_array(el.id, ascii_data(raw), raw)
+
+    def add_array(self, p, el):
+        """add_reference in variables_only mode, where the other records are only classes
+        """
+        if self.inspect_arrays and isinstance(el, PrimitiveArrayDump):
+            raw = self.array_data(el)
+            self.inspect_array(el.id, ascii_data(raw), raw)
+
+    def inspect_array(self, id, data, raw):
+        """Look for results in the ASCII contents `data` of the primitive array whose
+        contents are `raw`
+        """
+        if b'HTTP/1.1' in data:
+            self.emit('http', (id, data))
+        if self.scanner is not None:
+            for name, offset, match in self.scanner.scan_once(data):
+                self.emit('secret', (SecretHit(name, id, ascii_offset(raw, offset), match), data))
+
+    def add_variable_candidate(self, key, value, layout):
+        if self.events is not None:
+            self.events.append(('candidate', (key, value, layout)))
+            return
+        if layout == 1:
+            # Type 1 skips a key that repeats the previous variable's value
+            if self.last_item is not None and self.last_item == key:
+                return
+            self.last_item = value
+        self.add_variable(key, value)
+
+    def add_variable(self, key, value):
+        if key not in self.variables.keys():
+            self.variables[key] = [value]
+        else:
+            self.variables[key].append(value)
+        self.emit('variable', (key, value))
 
     '''
     
@@ -211,40 +786,22 @@ class ReferenceBuilder(object):
     Key as PrimitiveArrayDump -> InstanceDump -> Value as PrimitiveArrayDump
 
     '''
-    def parse_type_one_references(self, heap_dump, mx, p, references):
-        last_item = None
-        for i in range(len(references)):
-            el = references[i]
+    def parse_type_one_references(self, heap_dump, mx, p, references, first_index=0, window=()):
+        window = deque(window, maxlen=2)
+        for i, el in enumerate(references, first_index):
             if mx is not None and i > mx:
                 break
-            if isinstance(el, ClassDump):
-                self.classes[el.id] = JavaClass(el.id, self.strings[self.class_name_ids[el.id]],
-                                                el.super_class_id,
-                                                el.instance_fields, el.static_fields, el.constants_pool)
-            elif isinstance(el, InstanceDump):
-                self.references[el.id] = InstanceReference.build_from_instance_dump(
-                    self.strings,
-                    self.classes[el.class_object_id],
-                    el
-                )
-            elif isinstance(el, ObjectArrayDump):
-                self.references[el.id] = ObjectArrayReference(el.id, el.elements)
-            elif isinstance(el, PrimitiveArrayDump):
-                self.references[el.id] = PrimitiveArrayReference(el.id, el.element_type, p.type_size(el.element_type), el.size, el.data)
-                if i >= 2:
-                    if (type(references[i-2]) == PrimitiveArrayDump and
-                        type(references[i-1]) == InstanceDump):
-
-                        key = self.references[references[i-2].id].ascii_data()
-                        value = self.references[references[i].id].ascii_data()
-
-                        if key.strip() != b'' and value.strip() != b'':
-                            if last_item == None or last_item != key:
-                                last_item = value
-                                if key not in self.variables.keys():
-                                    self.variables[key] = [value]
-                                else:
-                                    self.variables[key].append(value)
+            self.add_reference(p, el)
+            if isinstance(el, PrimitiveArrayDump) and i >= 2:
+                if (record_class(window[0]) == PrimitiveArrayDump and
+                    record_class(window[1]) == InstanceDump):
+
+                    key = ascii_data(self.array_data(window[0]))
+                    value = ascii_data(self.array_data(el))
+
+                    if key.strip() != b'' and value.strip() != b'':
+                        self.add_variable_candidate(key, value, 1)
+            window.append(el)
 
     '''
     
@@ -255,35 +812,56 @@ class ReferenceBuilder(object):
     Key as PrimitiveArrayDump (bytes) -> Key as PrimitiveArrayDump (string) -> InstanceDump -> InstanceDump -> Value as PrimitiveArrayDump (bytes) -> Value as PrimitiveArrayDump (string)
 
     '''
-    def parse_type_two_references(self, heap_dump, mx, p, references):
-        for i in range(len(references)):
-            el = references[i]
+    def parse_type_two_references(self, heap_dump, mx, p, references, first_index=0, window=()):
+        window = deque(window, maxlen=3)
+        for i, el in enumerate(references, first_index):
             if mx is not None and i > mx:
                 break
-            if isinstance(el, ClassDump):
-                self.classes[el.id] = JavaClass(el.id, self.strings[self.class_name_ids[el.id]],
-                                                el.super_class_id,
-                                                el.instance_fields, el.static_fields, el.constants_pool)
-            elif isinstance(el, InstanceDump):
-                self.references[el.id] = InstanceReference.build_from_instance_dump(
-                    self.strings,
-                    self.classes[el.class_object_id],
-                    el
-                )
-            elif isinstance(el, ObjectArrayDump):
-                self.references[el.id] = ObjectArrayReference(el.id, el.elements)
-            elif isinstance(el, PrimitiveArrayDump):
-                self.references[el.id] = PrimitiveArrayReference(el.id, el.element_type, p.type_size(el.element_type), el.size, el.data)
-                if i >= 4:
-                    if(type(references[i-1]) == InstanceDump and
-                        type(references[i-2]) == InstanceDump and
-                        type(references[i-3]) == PrimitiveArrayDump):
-
-                        key = self.references[references[i-3].id].ascii_data()
-                        value = self.references[references[i].id].ascii_data()
-
-                        if key.strip() != b'' and value.strip() != b'':
-                            if key not in self.variables.keys():
-                                self.variables[key] = [value]
-                            else:
-                                self.variables[key].append(value)
+            self.add_reference(p, el)
+            if isinstance(el, PrimitiveArrayDump) and i >= 4:
+                if(record_class(window[2]) == InstanceDump and
+                    record_class(window[1]) == InstanceDump and
+                    record_class(window[0]) == PrimitiveArrayDump):
+
+                    key = ascii_data(self.array_data(window[0]))
+                    value = ascii_data(self.array_data(el))
+
+                    if key.strip() != b'' and value.strip() != b'':
+                        self.add_variable_candidate(key, value, 2)
+            window.append(el)
+
+
+segment_builder = None
+
+
+def init_segment_worker(filename, flags, strings, class_name_ids, classes):
+    global segment_builder
+    segment_builder = ReferenceBuilder(open(filename, 'rb'), flags)
+    segment_builder.p = HProfParser(segment_builder.f, segment_builder.use_mmap)
+    segment_builder.payloads = PayloadLoader(segment_builder.p, segment_builder.payload_cache)
+    segment_builder.strings = strings
+    segment_builder.class_name_ids = class_name_ids
+    segment_builder.classes = classes
+
+
+def parse_segment(segment):
+    """Parse one heap dump chunk in a worker, returning the classes, object store, and
+    variable candidates and results (in the order they were found) of it, or None if it
+    needs classes from other chunks
+    """
+    start, length, first_index, lookbehind_start, mx = segment
+    rb = segment_builder
+    known_classes = rb.classes
+    rb.classes = dict(known_classes)
+    rb.references = ObjectStore(None, rb.p.id_size)
+    rb.events = []
+    if rb.instrumentation is not None:
+        rb.instrumentation = Instrumentation()
+    try:
+        rb.read_heap_dump(HeapDump(0x1C, rb.p, 0, start, length), mx, first_index, lookbehind_start)
+    except KeyError:
+        return None
+    finally:
+        classes, rb.classes = rb.classes, known_classes
+    new_classes = dict((id, c) for id, c in classes.items() if id not in known_classes)
+    return new_classes, rb.references, rb.events, rb.instrumentation
@@ -0,0 +1,176 @@
+"""Scanning the contents of primitive arrays for secrets with many regular expressions.
+
+Each buffer is searched once with all the patterns combined into a single alternation,
+and only buffers that match are searched with the individual patterns. A buffer identical
+to one of the recently scanned ones is not scanned again.
+"""
+
+import hashlib
+import multiprocessing
+import re
+from collections import OrderedDict
+from itertools import islice
+
+INLINE_FLAGS = ((re.IGNORECASE, b'i'), (re.MULTILINE, b'm'), (re.DOTALL, b's'), (re.VERBOSE, b'x'))
+# Global flags at the start of a pattern, which are kept in its flags instead
+LEADING_FLAGS = re.compile(br'^\(\?[aiLmsux]+\)')
+
+
+def compile_pattern(pattern):
+    """Bytes version of a str, bytes or compiled pattern, keeping its flags
+    """
+    if not hasattr(pattern, 'pattern'):
+        pattern = re.compile(pattern)
+    source = pattern.pattern
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    source = LEADING_FLAGS.sub(b'', source)
+    return re.compile(source, pattern.flags & (re.IGNORECASE | re.MULTILINE | re.DOTALL | re.VERBOSE))
+
+
+def combine_patterns(patterns):
+    """One pattern matching wherever any of the compiled bytes patterns match, or None if
+    they cannot be combined (e.g. they use numbered backreferences)
+    """
+    parts = []
+    for pattern in patterns:
+        flags = b''.join(letter for flag, letter in INLINE_FLAGS if pattern.flags & flag)
+        parts.append(b'(?' + flags + b':' + pattern.pattern + b')')
+    try:
+        return re.compile(b'|'.join(parts))
+    except re.error:
+        return None
+
+
+class SecretHit(object):
+    """A match of the pattern called `name` at `offset` in the contents of object `id`
+    """
+
+    def __init__(self, name, id, offset, match):
+        self.name = name
+        self.id = id
+        self.offset = offset
+        self.match = match
+
+    def __repr__(self):
+        return 'SecretHit(%r, 0x%x, %d, %r)' % (self.name, self.id, self.offset, self.match)
+
+
+class SecretScanner(object):
+    """Finds matches of named patterns in many buffers.
+
+    `patterns` is a dict, or a list of (name, pattern) pairs, where patterns are str, bytes
+    or compiled regular expressions. They are all run on bytes, so str patterns should
+    only match ASCII. With `workers` > 1 the buffers are scanned in a process pool,
+    `batch_size` of them at a time.
+
+    The matches of the last `max_digests` distinct buffers scanned are kept by a digest of
+    their contents, and reused for identical buffers.
+    """
+
+    def __init__(self, patterns, workers=1, batch_size=4096, max_digests=2 ** 16):
+        self.patterns = [(name, compile_pattern(pattern)) for name, pattern in dict(patterns).items()]
+        self.prefilter = combine_patterns([pattern for name, pattern in self.patterns])
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_digests = max_digests
+        # Matches by content digest, least recently used first
+        self.digests = OrderedDict()
+
+    def cached_hits(self, digest):
+        hits = self.digests.get(digest)
+        if hits is not None:
+            self.digests.move_to_end(digest)
+        return hits
+
+    def remember(self, digest, hits):
+        self.digests[digest] = hits
+        if len(self.digests) > self.max_digests:
+            self.digests.popitem(last=False)
+
+    def scan_buffer(self, data):
+        """Matches in one buffer as (name, offset, matched bytes), by pattern then offset
+        """
+        if self.prefilter is not None and self.prefilter.search(data) is None:
+            return ()
+        hits = []
+        for name, pattern in self.patterns:
+            for m in pattern.finditer(data):
+                hits.append((name, m.start(), m.group(0)))
+        return hits
+
+    def scan_once(self, data):
+        """scan_buffer, reusing the matches of an identical buffer scanned recently
+        """
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        hits = self.cached_hits(digest)
+        if hits is None:
+            hits = tuple(self.scan_buffer(data))
+            self.remember(digest, hits)
+        return hits
+
+    def scan(self, items):
+        """Yield a SecretHit for every match in an iterable of (object id, data) pairs
+        """
+        pool = None
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers, init_scan_worker, (self.patterns,))
+        try:
+            items = iter(items)
+            while True:
+                batch = list(islice(items, self.batch_size))
+                if not batch:
+                    break
+                digests = [hashlib.blake2b(data, digest_size=16).digest() for id, data in batch]
+                # Matches of the batch's buffers, and the buffers not scanned recently
+                found = {}
+                todo = {}
+                for (id, data), digest in zip(batch, digests):
+                    if digest in found or digest in todo:
+                        continue
+                    hits = self.cached_hits(digest)
+                    if hits is None:
+                        todo[digest] = data
+                    else:
+                        found[digest] = hits
+                if pool is None:
+                    results = map(self.scan_buffer, todo.values())
+                else:
+                    results = pool.map(scan_buffer, [bytes(data) for data in todo.values()],
+                                       max(1, len(todo) // (self.workers * 4)))
+                for digest, hits in zip(todo, results):
+                    found[digest] = hits = tuple(hits)
+                    self.remember(digest, hits)
+                for (id, data), digest in zip(batch, digests):
+                    for name, offset, match in found[digest]:
+                        yield SecretHit(name, id, offset, match)
+            if pool is not None:
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def scan_references(self, references):
+        """Scan the ASCII contents (see PrimitiveArrayReference.ascii_data) of the primitive
+        arrays among `references`. Offsets are into the arrays' contents as dumped
+        """
+        # The references stand in for their ids until the offsets are mapped back
+        hits = self.scan((r, r.ascii_data()) for r in references if hasattr(r, 'ascii_data'))
+        for hit in hits:
+            r = hit.id
+            hit.id = r.id
+            hit.offset = r.ascii_offset(hit.offset)
+            yield hit
+
+
+scan_worker = None
+
+
+def init_scan_worker(patterns):
+    global scan_worker
+    scan_worker = SecretScanner(patterns)
+
+
+def scan_buffer(data):
+    return scan_worker.scan_buffer(data)
@@ -0,0 +1,249 @@
+"""Compact, array backed table of the objects in a heap dump.
+
+Every object is a row across parallel typed arrays, and outgoing references are
+kept in a CSR style edge array. Reference objects are only built on demand by
+re-reading the object's record from the dump.
+"""
+
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from weakref import WeakValueDictionary
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from .constants import HEAP_DUMP_SUB_TAGS, OBJECT_TYPES, OBJECT_TYPE_CODES
+from .parsers import ID_CODES
+
+KIND_CODES = dict((name, tag) for tag, name in HEAP_DUMP_SUB_TAGS.items())
+# Rows sorted at a time when ordering rows by id
+SORT_CHUNK_ROWS = 2 ** 16
+
+
+def sort_ids(ids, id_code):
+    """(sorted ids, their row numbers) of an array of ids, as typed arrays. Chunks of
+    SORT_CHUNK_ROWS rows are sorted one at a time and merged into the arrays, so no list of
+    every row is built
+    """
+    runs = []
+    for start in range(0, len(ids), SORT_CHUNK_ROWS):
+        rows = array('I', sorted(range(start, min(start + SORT_CHUNK_ROWS, len(ids))), key=ids.__getitem__))
+        runs.append(zip(array(id_code, map(ids.__getitem__, rows)), rows))
+    sorted_ids = array(id_code)
+    order = array('I')
+    for id, row in merge(*runs):
+        sorted_ids.append(id)
+        order.append(row)
+    return sorted_ids, order
+
+
+class StoreChildren(Mapping):
+    """Children of a reference loaded from an ObjectStore, resolved to references on access.
+    `ids` maps field names to ids, or is the array of element ids of an object array, whose
+    children are keyed by index
+    """
+
+    __slots__ = ('store', 'ids')
+
+    def __init__(self, store, ids):
+        self.store = store
+        self.ids = ids
+
+    def __getitem__(self, k):
+        ids = self.ids
+        if not isinstance(ids, dict) and not (isinstance(k, int) and 0 <= k < len(ids)):
+            raise KeyError(k)
+        return self.store.get(ids[k])
+
+    def __iter__(self):
+        if isinstance(self.ids, dict):
+            return iter(self.ids)
+        return iter(range(len(self.ids)))
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ObjectStore(object):
+    """Mapping of object id to reference backed by parallel typed arrays.
+
+    Row i of the table holds `ids[i]`, the sub-record tag in `kinds[i]`, the index of the
+    object's class in `class_ids` (minus the element type code for primitive arrays) in
+    `class_indexes[i]`, the file offset of the record in `offsets[i]` and the shallow size
+    in `sizes[i]`. Its outgoing references are `edges[edge_offsets[i]:edge_offsets[i + 1]]`.
+    The GC roots are kept as object ids in `root_ids` with their sub-record tag in `root_kinds`.
+
+    Ids, edges and root ids are stored in 32 bits for dumps with 4 byte ids.
+
+    `load_reference` is called with a record offset to build the reference object for a
+    row. Built references are cached weakly, so a row maps to a single object while it is
+    in use.
+    """
+
+    def __init__(self, load_reference, id_size=8):
+        self.load_reference = load_reference
+        self.id_size = id_size
+        id_code = ID_CODES[id_size]
+        self.ids = array(id_code)
+        self.kinds = array('B')
+        self.class_indexes = array('i')
+        self.offsets = array('Q')
+        self.sizes = array('Q')
+        self.edge_offsets = array('Q', [0])
+        self.edges = array(id_code)
+        self.root_ids = array(id_code)
+        self.root_kinds = array('B')
+        self.class_ids = []
+        self.class_index_by_id = {}
+        # Sorted ids and their row numbers, only built when ids were not added in ascending order
+        self.ascending = True
+        self.sorted_ids = None
+        self.order = None
+        self.cache = WeakValueDictionary()
+
+    def class_index(self, class_id):
+        try:
+            return self.class_index_by_id[class_id]
+        except KeyError:
+            i = self.class_index_by_id[class_id] = len(self.class_ids)
+            self.class_ids.append(class_id)
+            return i
+
+    def add(self, id, kind, class_id, offset, size, edges=()):
+        """Append a row. For primitive arrays `class_id` is the element type name
+        """
+        if self.ascending and self.ids and id <= self.ids[-1]:
+            self.ascending = False
+        if kind == 'PRIMITIVE_ARRAY_DUMP':
+            class_index = -OBJECT_TYPE_CODES[class_id]
+        else:
+            class_index = self.class_index(class_id)
+        self.ids.append(id)
+        self.kinds.append(KIND_CODES[kind])
+        self.class_indexes.append(class_index)
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.edges.extend(edges)
+        self.edge_offsets.append(len(self.edges))
+
+    def add_root(self, id, kind):
+        self.root_ids.append(id)
+        self.root_kinds.append(KIND_CODES[kind])
+
+    def merge(self, other):
+        """Append the rows of another store, as built for a separate heap dump segment
+        """
+        class_indexes = dict((-code, -code) for code in OBJECT_TYPES)
+        class_indexes.update((i, self.class_index(class_id)) for i, class_id in enumerate(other.class_ids))
+        if self.ascending and (not other.ascending or (self.ids and other.ids and other.ids[0] <= self.ids[-1])):
+            self.ascending = False
+        self.ids.extend(other.ids)
+        self.kinds.extend(other.kinds)
+        self.class_indexes.extend(array('i', map(class_indexes.__getitem__, other.class_indexes)))
+        self.offsets.extend(other.offsets)
+        self.sizes.extend(other.sizes)
+        self.edge_offsets.extend(array('Q', map(len(self.edges).__add__, other.edge_offsets[1:])))
+        self.edges.extend(other.edges)
+        self.root_ids.extend(other.root_ids)
+        self.root_kinds.extend(other.root_kinds)
+
+    def __getstate__(self):
+        state = dict(vars(self))
+        del state['load_reference'], state['cache']
+        return state
+
+    def __setstate__(self, state):
+        vars(self).update(state)
+        self.load_reference = None
+        self.cache = WeakValueDictionary()
+
+    def index(self, id):
+        """Row number of an object id, or -1 if the object is not in the store
+        """
+        ids = self.ids
+        if self.ascending:
+            i = bisect_left(ids, id)
+            if i < len(ids) and ids[i] == id:
+                return i
+            return -1
+        if self.order is None or len(self.order) != len(ids):
+            self.sorted_ids, self.order = sort_ids(ids, ID_CODES[self.id_size])
+        sorted_ids = self.sorted_ids
+        i = bisect_left(sorted_ids, id)
+        if i < len(sorted_ids) and sorted_ids[i] == id:
+            return self.order[i]
+        return -1
+
+    def kind(self, i):
+        return HEAP_DUMP_SUB_TAGS[self.kinds[i]]
+
+    def class_id(self, i):
+        class_index = self.class_indexes[i]
+        if class_index < 0:
+            return None
+        return self.class_ids[class_index]
+
+    def children_ids(self, i):
+        return self.edges[self.edge_offsets[i]:self.edge_offsets[i + 1]]
+
+    def reference(self, i):
+        id = self.ids[i]
+        try:
+            return self.cache[id]
+        except KeyError:
+            pass
+        r = self.load_reference(self.offsets[i])
+        if r is not None:
+            r.children = StoreChildren(self, r.children)
+            self.cache[id] = r
+        return r
+
+    @property
+    def nbytes(self):
+        columns = [self.ids, self.kinds, self.class_indexes, self.offsets, self.sizes,
+                   self.edge_offsets, self.edges, self.root_ids, self.root_kinds]
+        if self.order is not None:
+            columns.extend((self.sorted_ids, self.order))
+        return sum(c.itemsize * len(c) for c in columns)
+
+    def rows(self, kind=None):
+        if kind is None:
+            return range(len(self.ids))
+        code = KIND_CODES[kind]
+        kinds = self.kinds
+        return (i for i in range(len(kinds)) if kinds[i] == code)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return self.index(id) >= 0
+
+    def __getitem__(self, id):
+        i = self.index(id)
+        if i < 0:
+            raise KeyError(id)
+        return self.reference(i)
+
+    def get(self, id, default=None):
+        i = self.index(id)
+        if i < 0:
+            return default
+        return self.reference(i)
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self, kind=None):
+        ids = self.ids
+        return (ids[i] for i in self.rows(kind))
+
+    def values(self, kind=None):
+        return (self.reference(i) for i in self.rows(kind))
+
+    def items(self, kind=None):
+        ids = self.ids
+        return ((ids[i], self.reference(i)) for i in self.rows(kind))
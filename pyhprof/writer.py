@@ -0,0 +1,234 @@
+"""Writing Java hprof files, and generating synthetic heap dumps for benchmarks.
+"""
+
+import os
+import struct
+
+from .constants import TAGS, HEAP_DUMP_SUB_TAGS, OBJECT_TYPE_CODES, TYPE_STRUCT_CODES
+from .parsers import RECORD_STRUCTS, RECORD_HEADER
+
+TAG_CODES = dict((name, tag) for tag, name in TAGS.items())
+SUB_TAG_CODES = dict((name, tag) for tag, name in HEAP_DUMP_SUB_TAGS.items())
+
+# Layouts of the GC root sub-records after their tag
+ROOT_LAYOUTS = {
+    'ROOT_UNKNOWN': '>O',
+    'ROOT_JNI_GLOBAL': '>OO',
+    'ROOT_JNI_LOCAL': '>OII',
+    'ROOT_JAVA_FRAME': '>OII',
+    'ROOT_NATIVE_STACK': '>OI',
+    'ROOT_STICKY_CLASS': '>O',
+    'ROOT_THREAD_BLOCK': '>OI',
+    'ROOT_MONITOR_USED': '>O',
+    'ROOT_THREAD_OBJECT': '>OII'
+}
+
+
+class HProfWriter(object):
+    """Writes an hprof file record by record.
+
+    Heap dump sub-records are streamed into HEAP_DUMP_SEGMENT records of about
+    `segment_size` bytes, or into a single HEAP_DUMP record if `segment_size` is None, whose
+    lengths are filled in once they are complete, so `f` must be seekable. Values are
+    given as the unsigned integers or floats the parsers return.
+    """
+
+    def __init__(self, f, id_size=8, format=b'JAVA PROFILE 1.0.2', start_time=0, segment_size=2 ** 20):
+        self.f = f
+        self.id_size = id_size
+        self.structs = RECORD_STRUCTS[id_size]
+        self.segment_size = segment_size
+        self.strings = {}
+        self.next_string_id = 1
+        self.class_serial_number = 0
+        # Instance field types of each dumped class, and its super class id
+        self.class_fields = {}
+        self.super_class_ids = {}
+        self.heap_dump_start = None
+        f.write(format + b'\0')
+        f.write(struct.pack('>IQ', id_size, start_time))
+
+    def pack(self, fmt, *values):
+        return self.structs[fmt].pack(*values)
+
+    def write_record(self, tag_name, body, record_time=0):
+        self.end_heap_dump()
+        self.f.write(RECORD_HEADER.pack(TAG_CODES[tag_name], record_time, len(body)))
+        self.f.write(body)
+
+    def string(self, s):
+        """Id of a STRING record holding `s`, writing it the first time
+        """
+        try:
+            return self.strings[s]
+        except KeyError:
+            pass
+        id = self.strings[s] = self.next_string_id
+        self.next_string_id += 1
+        self.write_record('STRING', self.pack('>O', id) + s.encode('utf-8'))
+        return id
+
+    def load_class(self, class_id, name):
+        name_id = self.string(name)
+        self.class_serial_number += 1
+        self.write_record('LOAD_CLASS', self.pack('>IOIO', self.class_serial_number, class_id, 0, name_id))
+
+    def value(self, tp, value):
+        return self.pack('>' + TYPE_STRUCT_CODES[tp], value)
+
+    def write_sub_record(self, body):
+        if self.heap_dump_start is None:
+            self.f.write(RECORD_HEADER.pack(TAG_CODES['HEAP_DUMP' if self.segment_size is None else 'HEAP_DUMP_SEGMENT'], 0, 0))
+            self.heap_dump_start = self.f.tell()
+        self.f.write(body)
+        if self.segment_size is not None and self.f.tell() - self.heap_dump_start >= self.segment_size:
+            self.end_heap_dump()
+
+    def end_heap_dump(self):
+        if self.heap_dump_start is None:
+            return
+        end = self.f.tell()
+        self.f.seek(self.heap_dump_start - 4)
+        self.f.write(struct.pack('>I', end - self.heap_dump_start))
+        self.f.seek(end)
+        self.heap_dump_start = None
+
+    def root(self, tag_name, id, *values):
+        self.write_sub_record(bytes([SUB_TAG_CODES[tag_name]]) + self.pack(ROOT_LAYOUTS[tag_name], id, *values))
+
+    def class_dump(self, id, super_class_id=0, instance_fields=(), static_fields=(), constants=()):
+        """Dump a class. `instance_fields` is a list of (name, type name) and `static_fields`
+        and `constants` are lists of (name or constant pool index, type name, value)
+        """
+        self.class_fields[id] = [tp for name, tp in instance_fields]
+        self.super_class_ids[id] = super_class_id
+        instance_size = sum(self.structs['>' + TYPE_STRUCT_CODES[tp]].size for name, tp in instance_fields)
+        body = [bytes([SUB_TAG_CODES['CLASS_DUMP']]),
+                self.pack('>OIOOOOOOIH', id, 0, super_class_id, 0, 0, 0, 0, 0, instance_size, len(constants))]
+        for index, tp, value in constants:
+            body.append(self.pack('>HB', index, OBJECT_TYPE_CODES[tp]) + self.value(tp, value))
+        body.append(self.pack('>H', len(static_fields)))
+        for name, tp, value in static_fields:
+            body.append(self.pack('>OB', self.string(name), OBJECT_TYPE_CODES[tp]) + self.value(tp, value))
+        body.append(self.pack('>H', len(instance_fields)))
+        for name, tp in instance_fields:
+            body.append(self.pack('>OB', self.string(name), OBJECT_TYPE_CODES[tp]))
+        self.write_sub_record(b''.join(body))
+
+    def instance(self, id, class_id, values):
+        """Dump an instance of a dumped class, with `values` for the fields of the class and
+        then those of its super classes
+        """
+        types = []
+        c = class_id
+        while c:
+            types.extend(self.class_fields[c])
+            c = self.super_class_ids[c]
+        data = b''.join(self.value(tp, v) for tp, v in zip(types, values))
+        self.write_sub_record(bytes([SUB_TAG_CODES['INSTANCE_DUMP']]) +
+                              self.pack('>OIOI', id, 0, class_id, len(data)) + data)
+
+    def object_array(self, id, array_class_id, elements):
+        self.write_sub_record(bytes([SUB_TAG_CODES['OBJECT_ARRAY_DUMP']]) +
+                              self.pack('>OIIO', id, 0, len(elements), array_class_id) +
+                              self.pack('>%dO' % len(elements), *elements))
+
+    def primitive_array(self, id, element_type, data):
+        """Dump a primitive array from the big-endian bytes of its elements
+        """
+        size = self.structs['>' + TYPE_STRUCT_CODES[element_type]].size
+        self.write_sub_record(bytes([SUB_TAG_CODES['PRIMITIVE_ARRAY_DUMP']]) +
+                              self.pack('>OIIB', id, 0, len(data) // size, OBJECT_TYPE_CODES[element_type]) + data)
+
+    def close(self):
+        self.end_heap_dump()
+        if self.segment_size is not None:
+            self.write_record('HEAP_DUMP_END', b'')
+
+
+def generate(f, id_size=8, format=b'JAVA PROFILE 1.0.2', segment_size=2 ** 20, classes=100,
+             instances=100000, object_arrays=10000, primitive_arrays=50000, strings=1000,
+             variables=1000, secret_every=10):
+    """Write a synthetic heap dump to `f`.
+
+    The dump has `classes` classes with a mix of field types, `instances` instances
+    linked to each other, `object_arrays` arrays of them, `primitive_arrays` byte and char
+    arrays, `strings` extra STRING records and `variables` Spring environment variables
+    in the layout the variable heuristics expect for the format (type 1 for 1.0.1, type 2
+    for 1.0.2), every `secret_every`th one holding an AWS-style key.
+    """
+    w = HProfWriter(f, id_size, format, segment_size=segment_size)
+    for i in range(strings):
+        w.string('synthetic string %d' % i)
+
+    object_class = 0x1000
+    string_class = 0x1008
+    array_class = 0x1010
+    w.load_class(object_class, 'java/lang/Object')
+    w.load_class(string_class, 'java/lang/String')
+    w.load_class(array_class, '[Ljava/lang/Object;')
+    class_ids = [0x2000 + 8 * i for i in range(classes)]
+    for i, class_id in enumerate(class_ids):
+        w.load_class(class_id, 'com/example/Synthetic%d' % i)
+
+    w.root('ROOT_STICKY_CLASS', object_class)
+    w.root('ROOT_THREAD_OBJECT', 0x100, 1, 1)
+    w.class_dump(object_class)
+    w.class_dump(string_class, object_class, [('value', 'OBJECT'), ('hash', 'INT'), ('coder', 'BYTE')])
+    w.class_dump(array_class, object_class)
+    field_types = ['OBJECT', 'INT', 'LONG', 'BOOLEAN', 'OBJECT', 'DOUBLE']
+    for i, class_id in enumerate(class_ids):
+        super_class_id = class_ids[i - 1] if i % 4 else object_class
+        fields = [('f%d_%d' % (i, j), field_types[(i + j) % len(field_types)]) for j in range(2 + i % 3)]
+        w.class_dump(class_id, super_class_id, fields, [('COUNT', 'INT', i)], [(1, 'INT', i)])
+
+    ids = iter(range(0x10000, 2 ** 62, 8))
+
+    layout = 1 if b'1.0.1' in format else 2
+    for i in range(variables):
+        value = 'value-%d' % i
+        if secret_every and i % secret_every == 0:
+            value += ' AKIA%016d' % i
+        key_id = next(ids)
+        w.primitive_array(key_id, 'BYTE', ('VARIABLE_%d' % i).encode())
+        if layout == 2:
+            w.primitive_array(next(ids), 'BYTE', ('VARIABLE_%d' % i).encode())
+        for _ in range(layout):
+            w.instance(next(ids), string_class, [key_id, 0, 0])
+        if layout == 2:
+            w.primitive_array(next(ids), 'BYTE', value.encode())
+        w.primitive_array(next(ids), 'BYTE', value.encode())
+
+    # The other objects are written in runs of each kind, so that they do not look like
+    # variables to the heuristics
+    previous = 0
+    objects = []
+    for start in range(0, max(instances, primitive_arrays, object_arrays), 16):
+        for i in range(start, min(start + 16, primitive_arrays)):
+            if i % 2:
+                w.primitive_array(next(ids), 'CHAR', ('chars %d' % i).encode('utf-16-be'))
+            else:
+                w.primitive_array(next(ids), 'BYTE', ('bytes %d' % i).encode())
+        for i in range(start, min(start + 16, instances)):
+            class_id = class_ids[i % classes]
+            values = []
+            c = class_id
+            while c != object_class:
+                for tp in w.class_fields[c]:
+                    values.append(previous if tp == 'OBJECT' else i if tp in ('INT', 'LONG') else
+                                  1 if tp == 'BOOLEAN' else float(i))
+                c = w.super_class_ids[c]
+            previous = next(ids)
+            w.instance(previous, class_id, values)
+            objects.append(previous)
+            del objects[:-16]
+        for i in range(start, min(start + 16, object_arrays)):
+            w.object_array(next(ids), array_class, objects[i % 8:i % 8 + 4])
+    w.root('ROOT_JNI_GLOBAL', previous, 1)
+    w.close()
+
+
+def generate_file(path, **kwargs):
+    with open(path, 'wb') as f:
+        generate(f, **kwargs)
+    return os.path.getsize(path)
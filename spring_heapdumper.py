@@ -1,14 +1,24 @@
 #!/bin/python3
 
-from pyhprof.parsers import HProfParser
 from pyhprof.references import ReferenceBuilder
-import pyhprof
+from pyhprof.secret_scanner import SecretScanner
+from pyhprof.instrumentation import Instrumentation
+from pyhprof.cache import HeapCache, DEFAULT_CACHE_DIR
 import argparse
+import json
 import sys
 
 # Use truffleHog to parse any references for common API keys
 from truffleHogRegexes.regexChecks import regexes
-import re
+
+def print_progress(instrumentation):
+	done = instrumentation.bytes_done / 2 ** 20
+	if instrumentation.total_bytes is None:
+		sys.stderr.write("%s: %.0f MB\n" % (instrumentation.phase_name, done))
+		return
+	eta = instrumentation.eta
+	sys.stderr.write("%s: %.0f / %.0f MB, ETA %s\n" % (instrumentation.phase_name, done,
+		instrumentation.total_bytes / 2 ** 20, '?' if eta is None else '%.0fs' % eta))
 
 def main():
 	flags = {}
@@ -19,6 +29,25 @@ def main():
 	                    help='Force Type 1 parsing of variables')
 	parser.add_argument('-t2', '--type-two', action='store_true',
 	                    help='Force Type 2 parsing of variables')
+	parser.add_argument('-m', '--mmap', action='store_true',
+	                    help='Memory map the HPROF instead of reading it through file reads')
+	parser.add_argument('-i', '--index', action='store_true',
+	                    help='Use (and create if needed) a sidecar index next to the HPROF to skip the '
+	                         'scan of its top-level records; heap dumps are still parsed in full (see -c)')
+	parser.add_argument('-w', '--workers', type=int, default=1,
+	                    help='Parse heap dump segments in this many processes')
+	parser.add_argument('-l', '--lazy-arrays', action='store_true',
+	                    help='Read primitive array contents only when they are needed')
+	parser.add_argument('-j', '--json', action='store_true',
+	                    help='Write results as JSON lines')
+	parser.add_argument('-P', '--progress', action='store_true',
+	                    help='Report parsing progress on stderr')
+	parser.add_argument('-s', '--summary', dest='summary',
+	                    help='Write a JSON summary of record counts and timings to this file')
+	parser.add_argument('-c', '--cache', nargs='?', const=DEFAULT_CACHE_DIR,
+	                    help='Cache the parsed dump in this directory (default %s) and reuse it on later runs' % DEFAULT_CACHE_DIR)
+	parser.add_argument('--cache-size', type=int, default=8192,
+	                    help='Evict the least recently used cached dumps beyond this many MB')
 
 	args = parser.parse_args()
 
@@ -34,39 +63,53 @@ def main():
 			flags['type_two'] = True
 		else:
 			flags['type_two'] = False
+	flags['mmap'] = args.mmap
+	flags['index'] = args.index
+	flags['workers'] = args.workers
+	flags['lazy_arrays'] = args.lazy_arrays
+	flags['scanner'] = SecretScanner(regexes)
+	# Only variables, HTTP references and secrets are printed, so no references are built
+	flags['variables_only'] = True
+	if args.cache:
+		flags['cache'] = HeapCache(args.cache, args.cache_size * 2 ** 20)
+	if args.progress or args.summary:
+		flags['instrumentation'] = Instrumentation(print_progress if args.progress else None)
 	
 	filename = args.filename
 	fp = open(filename, 'rb')
 	refs = ReferenceBuilder(fp, flags)
 
-	refs.build()
-
-	print("Variables:\n\n")
-
-	for i in refs.variables.keys():
-		key = i.decode("utf-8")
-		for v in refs.variables[i]:
-			print("%s: %s" % (key, v.decode("utf-8")))
-
-	http_references = []
-	secrets = []
-
-	for i in refs.references.keys():
-		if type(refs.references[i]) == pyhprof.references.PrimitiveArrayReference:
-			data = refs.references[i].ascii_data().decode("utf-8")
-			if 'HTTP/1.1' in data:
-				http_references.append(data)
-			for k in regexes.keys():
-				matches = regexes[k].findall(data)
-				if len(matches) != 0:
-					secrets.append("TruffleHog (%s): %s. Identified from: \n%s" % (k, matches, data))
+	# Results are printed as soon as they are found, so they are kept even if
+	# parsing does not finish
+	def print_result(kind, result):
+		if kind == 'variable':
+			key, value = result
+			if args.json:
+				line = json.dumps({'type': kind, 'key': key.decode("utf-8"), 'value': value.decode("utf-8")})
+			else:
+				line = "Variable %s: %s" % (key.decode("utf-8"), value.decode("utf-8"))
+		elif kind == 'http':
+			id, data = result
+			if args.json:
+				line = json.dumps({'type': kind, 'id': id, 'data': data.decode("utf-8")})
+			else:
+				line = "HTTP Reference:\n%s\n" % data.decode("utf-8")
+		elif kind == 'secret':
+			hit, data = result
+			if args.json:
+				line = json.dumps({'type': kind, 'name': hit.name, 'id': hit.id, 'offset': hit.offset,
+				                   'match': hit.match.decode("utf-8"), 'data': data.decode("utf-8")})
+			else:
+				line = "TruffleHog (%s): %s. Identified from: \n%s\n" % (hit.name, [hit.match.decode("utf-8")], data.decode("utf-8"))
+		else:
+			return
+		print(line, flush=True)
 
-	print("\n\nHTTP References:\n\n")
-	for i in http_references:
-		print(i + "\n")
+	refs.on_result(print_result)
+	refs.build()
 
-	print("\n\nSecret References:\n\n")
-	for i in secrets:
-		print(i + "\n")
+	if args.summary:
+		with open(args.summary, 'w') as f:
+			f.write(flags['instrumentation'].to_json(indent=2))
 
 main()
\ No newline at end of file